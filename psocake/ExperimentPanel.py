@@ -16,6 +16,7 @@ import time
 if 'LCLS' in os.environ['PSOCAKE_FACILITY'].upper():
     import psana
     import Detector.PyDetector
+    import eventIndex
 elif 'PAL' in os.environ['PSOCAKE_FACILITY'].upper():
     pass
 
@@ -49,6 +50,8 @@ class ExperimentInfo(object):
         self.eventTotal = 0
         self.run = None
         self.times = None
+        self.eventIndex = None
+        self.eventLookup = None
 
         self.disp_grp = 'Display'
         self.disp_log_str = 'Logscale'
@@ -392,9 +395,13 @@ class ExperimentInfo(object):
 
         if self.parent.args.v >= 1: print "Done updateDetInfo: ", self.parent.detInfo
 
-    def findEventFromTimestamp(self, secList, nsecList, fidList, sec, nsec, fid):
-        eventNumber = (np.where(secList == sec)[0] & np.where(nsecList == nsec)[0] & np.where(fidList == fid)[0])[0]
-        return eventNumber
+    def findEventFromTimestamp(self, sec, nsec, fid):
+        """Returns the event number of the run with timestamp sec, nsec and fiducial fid,
+           None if there is none or no run is open
+        """
+        if self.eventIndex is None: return None
+        if self.eventLookup is None: self.eventLookup = eventIndex.eventLookup(self.eventIndex)
+        return self.eventLookup.findEvent(sec, nsec, fid)
 
     def convertTimestamp64(self, t):
         _sec = int(t) >> 32
@@ -812,7 +819,13 @@ class ExperimentInfo(object):
                                                           '/' + self.parent.experimentName + '/xtc'
                 self.ds = psana.DataSource(access)
                 self.run = self.ds.runs().next()
-                self.times = self.run.times()
+                # Event times from the event index saved in the psocake run directory
+                self.setupRunDir()
+                self.eventIndex = eventIndex.getEventIndex(self.parent.experimentName, self.parent.runNumber,
+                                                           self.parent.psocakeRunDir, access=self.parent.access,
+                                                           run=self.run, dataDir=self.parent.dir)
+                self.eventLookup = None
+                self.times = eventIndex.eventTimes(self.eventIndex)
                 self.env = self.ds.env()
             except:
                 print "############# No such datasource exists ###############"
@@ -15,7 +15,9 @@ class HitFinder:
     def __init__(self,exp,run,detname,evt,detector,litPixelThreshold,
                  streakMask_on,streakMask_sigma,streakMask_width,userMask_path,psanaMask_on,psanaMask_calib,
                  psanaMask_status,psanaMask_edges,psanaMask_central,psanaMask_unbond,psanaMask_unbondnrs,
-                 **kwargs):
+                 shared=None,**kwargs):
+        """shared: arrays returned by makeSharedArrays for the run, used read-only instead of computing them
+        """
         self.exp = exp
         self.run = run
         self.detname = detname
@@ -40,28 +42,22 @@ class HitFinder:
         self.userPsanaMask = None
         self.combinedMask = None
 
-        # Make user mask
-        if self.userMask_path is not None:
-            self.userMask = np.load(self.userMask_path)
-
-        # Make psana mask
-        if self.psanaMask_on:
-            self.psanaMask = detector.mask(evt, calib=self.psanaMask_calib, status=self.psanaMask_status,
-                                           edges=self.psanaMask_edges, central=self.psanaMask_central,
-                                           unbond=self.psanaMask_unbond, unbondnbrs=self.psanaMask_unbondnrs)
-
-        # Combine userMask and psanaMask
-        self.userPsanaMask = np.ones_like(self.det.calib(evt))
-        if self.userMask is not None:
-            self.userPsanaMask *= self.userMask
-        if self.psanaMask is not None:
-            self.userPsanaMask *= self.psanaMask
+        # Masks
+        if shared is None:
+            shared = makeSharedArrays(detector,evt,userMask_path,psanaMask_on,psanaMask_calib,psanaMask_status,
+                                      psanaMask_edges,psanaMask_central,psanaMask_unbond,psanaMask_unbondnrs,
+                                      streakMask_width=streakMask_width)
+        self.userMask = shared.get('userMask')
+        self.psanaMask = shared.get('psanaMask')
+        self.userPsanaMask = shared['userPsanaMask']
 
         # Powder of hits and misses
         self.powderHits = np.zeros_like(self.userPsanaMask)
         self.powderMisses = np.zeros_like(self.userPsanaMask)
 
-        self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma)
+        self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma,
+                                              assem=shared.get('streakAssem'), imgEdges=shared.get('streakEdges'),
+                                              calibShape=self.userPsanaMask.shape)
 
     def findHits(self, calib, evt):
         if self.streakMask_on: # make new streak mask
@@ -82,3 +78,27 @@ class HitFinder:
         #else:
         #    self.powderMisses = np.maximum(self.powderMisses, calib)
 
+def makeSharedArrays(detector,evt,userMask_path,psanaMask_on,psanaMask_calib,psanaMask_status,psanaMask_edges,
+                     psanaMask_central,psanaMask_unbond,psanaMask_unbondnrs,streakMask_width=300):
+    """Returns the masks of a HitFinder, which only depend on the run.
+       The clients of a node compute them once and share them read-only, see nodeShared.py
+    """
+    userMask = None
+    psanaMask = None
+    # Make user mask
+    if userMask_path is not None:
+        userMask = np.load(userMask_path)
+    # Make psana mask
+    if str2bool(psanaMask_on):
+        psanaMask = detector.mask(evt, calib=str2bool(psanaMask_calib), status=str2bool(psanaMask_status),
+                                  edges=str2bool(psanaMask_edges), central=str2bool(psanaMask_central),
+                                  unbond=str2bool(psanaMask_unbond), unbondnbrs=str2bool(psanaMask_unbondnrs))
+    # Combine userMask and psanaMask
+    userPsanaMask = np.ones_like(detector.calib(evt))
+    if userMask is not None:
+        userPsanaMask *= userMask
+    if psanaMask is not None:
+        userPsanaMask *= psanaMask
+    streakMask = myskbeam.StreakMask(detector, evt, width=streakMask_width)
+    return {'userMask': userMask, 'psanaMask': psanaMask, 'userPsanaMask': userPsanaMask,
+            'streakAssem': streakMask.assem, 'streakEdges': getattr(streakMask, 'imgEdges', None)}
@@ -19,7 +19,9 @@ class PeakFinder:
                  hitParam_alg_amax_thr, hitParam_alg_atot_thr, hitParam_alg_son_min,
                  streakMask_on, streakMask_sigma, streakMask_width, userMask_path, psanaMask_on, psanaMask_calib,
                  psanaMask_status, psanaMask_edges, psanaMask_central, psanaMask_unbond, psanaMask_unbondnrs,
-                 generousMask=0, medianFilterOn=0, medianRank=5, radialFilterOn=0, distance=0.0, windows=None, **kwargs):
+                 generousMask=0, medianFilterOn=0, medianRank=5, radialFilterOn=0, distance=0.0, windows=None, shared=None, **kwargs):
+        """shared: arrays returned by makeSharedArrays for the run, used read-only instead of computing them
+        """
         self.exp = exp
         self.run = run
         self.detname = detname
@@ -59,31 +61,37 @@ class PeakFinder:
         self.userPsanaMask = None
         self.combinedMask = None
         self.generousMask = None
-
-        # Make user mask
-        if self.userMask_path is not None:
-            self.userMask = np.load(self.userMask_path)
+        # Masks in the dtype of the psana peak finders, see updateCombinedMask
+        self.userPsanaMask16 = None
+        self.streakCombinedMask = None
+        self.streakCombinedMask16 = None
+        self.combinedMask16 = None
 
         if facility == 'LCLS':
-            # Make psana mask
-            if self.psanaMask_on:
-                self.psanaMask = detector.mask(evt, calib=self.psanaMask_calib, status=self.psanaMask_status,
-                                               edges=self.psanaMask_edges, central=self.psanaMask_central,
-                                               unbond=self.psanaMask_unbond, unbondnbrs=self.psanaMask_unbondnrs)
-                if self.generousMaskOn:
-                    self.psanaMask = self.generousBadPixel(self.psanaMask)
-            # Combine userMask and psanaMask
-            self.userPsanaMask = np.ones_like(self.det.calib(evt), dtype=np.int16)
-            if self.userMask is not None:
-                self.userPsanaMask *= self.userMask
-            if self.psanaMask is not None:
-                self.userPsanaMask *= self.psanaMask
+            # Masks and pixel indices
+            if shared is None:
+                shared = makeSharedArrays(detector, evt, userMask_path, psanaMask_on, psanaMask_calib,
+                                          psanaMask_status, psanaMask_edges, psanaMask_central, psanaMask_unbond,
+                                          psanaMask_unbondnrs, generousMask=generousMask,
+                                          streakMask_width=streakMask_width)
+            self.userMask = shared.get('userMask')
+            self.psanaMask = shared.get('psanaMask')
+            self.userPsanaMask = shared['userPsanaMask']
         elif facility == 'PAL':
+            # Make user mask
+            if self.userMask_path is not None:
+                self.userMask = np.load(self.userMask_path)
             self.userPsanaMask = self.userMask
 
-        # Powder of hits and misses
+        # Powder of hits and misses (maximum), and their sum if powderMean, see updatePowder
+        self.minPeaks = kwargs.get("minNumPeaks", 15)
+        self.powderMean = kwargs.get("powderMean", False)
         self.powderHits = None
         self.powderMisses = None
+        self.powderHitsSum = None
+        self.powderMissesSum = None
+        self.numPowderHits = 0
+        self.numPowderMisses = 0
 
         # set algorithm specific parameters
         if algorithm == 1:
@@ -111,6 +119,7 @@ class PeakFinder:
 
         if facility == 'LCLS':
             self.access = kwargs["access"]
+            self.ps = kwargs.get("ps") # psanaWhisperer of the run, if any
             if self.algorithm == 1:
                 self.alg = PyAlgos(mask=None, pbits=0)
                 self.peakRadius = int(self.hitParam_alg1_radius)
@@ -130,13 +139,12 @@ class PeakFinder:
             self.alg = myskbeam.DropletA(self.peakRadius, self.hitParam_alg1_dr)
 
         if facility == 'LCLS':
-            self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma)
+            self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma,
+                                                  assem=shared.get('streakAssem'), imgEdges=shared.get('streakEdges'),
+                                                  calibShape=self.userPsanaMask.shape)
             self.cx, self.cy = self.det.point_indexes(evt, pxy_um=(0, 0))
-            self.iX = np.array(self.det.indexes_x(evt), dtype=np.int64)
-            self.iY = np.array(self.det.indexes_y(evt), dtype=np.int64)
-            if len(self.iX.shape) == 2:
-                self.iX = np.expand_dims(self.iX, axis=0)
-                self.iY = np.expand_dims(self.iY, axis=0)
+            self.iX = shared['iX']
+            self.iY = shared['iY']
             # Initialize radial background subtraction
             self.setupExperiment()
             if self.radialFilterOn:
@@ -159,17 +167,16 @@ class PeakFinder:
             self.iX = np.array(self.ix, dtype=np.int64)
             self.iY = np.array(self.iy, dtype=np.int64)
 
-    def generousBadPixel(self, unassemMask, n=10):
-        generousBadPixelMask = unassemMask
-        (numAsic, numFs, numSs) = unassemMask.shape
-        for i in range(numAsic):
-            for a in range(numSs):
-                numBadPixels = len(np.where(unassemMask[i, :, a] == 0)[0])
-                if numBadPixels >= n:
-                    generousBadPixelMask[i, :, a] = 0
-        return generousBadPixelMask
-
     def setupExperiment(self):
+        if self.ps is not None: # reuse the data source of the caller's psanaWhisperer
+            self.ds = self.ps.ds
+            self.run = self.ps.run
+            self.times = self.ps.times
+            self.eventTotal = len(self.times)
+            self.env = self.ps.env
+            self.evt = self.run.event(self.times[0])
+            self.det = self.ps.det
+            return
         access = 'exp=' + str(self.exp) + ':run=' + str(self.run) + ':idx'
         if 'ffb' in self.access.lower(): access += ':dir=/reg/d/ffb/' + self.exp[:3] + '/' + self.exp + '/xtc'
         self.ds = psana.DataSource(access)
@@ -184,16 +191,6 @@ class PeakFinder:
     def setupRadialBackground(self):
         self.geo = self.det.geometry(self.run)  # self.geo = GeometryAccess(self.parent.geom.calibPath+'/'+self.parent.geom.calibFile)
         self.xarr, self.yarr, self.zarr = self.geo.get_pixel_coords()
-        self.ix = self.det.indexes_x(self.evt)
-        self.iy = self.det.indexes_y(self.evt)
-        if self.ix is None:
-            self.iy = np.tile(np.arange(self.userMask.shape[1]), [self.userMask.shape[2], 1])
-            self.ix = np.transpose(self.iy)
-        self.iX = np.array(self.ix, dtype=np.int64)
-        self.iY = np.array(self.iy, dtype=np.int64)
-        if len(self.iX.shape) == 2:
-            self.iX = np.expand_dims(self.iX, axis=0)
-            self.iY = np.expand_dims(self.iY, axis=0)
         self.mask = self.geo.get_pixel_mask( mbits=0377)  # mask for 2x1 edges, two central columns, and unbound pixels with their neighbours
         self.rb = RadialBkgd(self.xarr, self.yarr, mask=self.mask, radedges=None, nradbins=100,
                              phiedges=(0, 360), nphibins=1)
@@ -201,6 +198,26 @@ class PeakFinder:
     def updatePolarizationFactor(self):
         self.pf = polarization_factor(self.rb.pixel_rad(), self.rb.pixel_phi(), self.distance * 1e6)  # convert to um
 
+    def updateCombinedMask(self):
+        """Sets combinedMask and combinedMask16 (uint16) from userPsanaMask and streakMask.
+           The static mask is converted once. A streak mask is combined into preallocated arrays.
+        """
+        if self.userPsanaMask is None:
+            self.combinedMask = self.combinedMask16 = None
+        elif self.streakMask is None:
+            if self.userPsanaMask16 is None:
+                self.userPsanaMask16 = self.userPsanaMask.astype(np.uint16)
+            self.combinedMask = self.userPsanaMask
+            self.combinedMask16 = self.userPsanaMask16
+        else:
+            if self.streakCombinedMask is None:
+                self.streakCombinedMask = np.empty(self.userPsanaMask.shape, dtype=self.userPsanaMask.dtype)
+                self.streakCombinedMask16 = np.empty(self.userPsanaMask.shape, dtype=np.uint16)
+            np.multiply(self.userPsanaMask, self.streakMask, out=self.streakCombinedMask, casting='unsafe')
+            np.copyto(self.streakCombinedMask16, self.streakCombinedMask, casting='unsafe')
+            self.combinedMask = self.streakCombinedMask
+            self.combinedMask16 = self.streakCombinedMask16
+
     def findPeaks(self, calib, evt, thr_high=None, thr_low=None):
 
         if facility == 'LCLS':
@@ -216,15 +233,12 @@ class PeakFinder:
                 calib = self.rb.subtract_bkgd(calib * self.pf)
                 calib.shape = self.userPsanaMask.shape  # FIXME: shape is 1d
 
-            if self.streakMask is not None:
-                self.combinedMask = self.userPsanaMask * self.streakMask
-            else:
-                self.combinedMask = self.userPsanaMask
+            self.updateCombinedMask()
 
             # set new mask
             #self.alg.set_mask(self.combinedMask) # This doesn't work reliably
         elif facility == 'PAL':
-            self.combinedMask = self.userMask
+            self.updateCombinedMask()
 
         # set algorithm specific parameters
         if self.algorithm == 1:
@@ -240,7 +254,7 @@ class PeakFinder:
                                                     rank = self.hitParam_alg1_rank,
                                                     r0=self.hitParam_alg1_radius,
                                                     dr=self.hitParam_alg1_dr,
-                                                    mask=self.combinedMask.astype(np.uint16))
+                                                    mask=self.combinedMask16)
 #                    self.peaks = self.alg.peak_finder_v4r2(calib,
 #                                                           thr_low=self.hitParam_alg1_thr_low,
 #                                                           thr_high=self.hitParam_alg1_thr_high,
@@ -266,11 +280,6 @@ class PeakFinder:
                 self.peakRadius = int(self.hitParam_alg1_radius)
                 _calib = np.zeros((1, calib.shape[0], calib.shape[1]))
                 _calib[0, :, :] = calib
-                if self.combinedMask is None:
-                    _mask = None
-                else:
-                    _mask = self.combinedMask.astype(np.uint16)
-
                 self.peaks = self.alg.findPeaks(_calib,
                                                 npix_min = self.npix_min,
                                                 npix_max = self.npix_max,
@@ -280,7 +289,7 @@ class PeakFinder:
                                                 atot_thr = self.atot_thr,
                                                 r0 = self.peakRadius,
                                                 dr = int(self.hitParam_alg1_dr),
-                                                mask = _mask)
+                                                mask = self.combinedMask16)
         elif self.algorithm == 2:
             if facility == 'LCLS':
                 #print "param: ", self.npix_min, self.npix_max, self.atot_thr, self.son_min, thr_low, thr_high, np.sum(self.combinedMask)
@@ -290,7 +299,7 @@ class PeakFinder:
                 self.peaks = self.alg.peak_finder_v3r3(calib, rank=int(self.hitParam_alg1_rank),
                                                        r0=self.peakRadius, dr=self.hitParam_alg1_dr,
                                                        nsigm=self.son_min,
-                                                       mask=self.combinedMask.astype(np.uint16))
+                                                       mask=self.combinedMask16)
         elif self.algorithm == 3:
             self.peaks = self.alg.peak_finder_v3(calib, rank=self.hitParam_alg3_rank, r0=self.hitParam_alg3_r0, dr=self.hitParam_alg3_dr)
         elif self.algorithm == 4:
@@ -315,19 +324,84 @@ class PeakFinder:
         else:
             self.maxRes = 0
 
-        if self.numPeaksFound >= 15:
-            if self.powderHits is None:
-                self.powderHits = calib
-            else:
-                self.powderHits = np.maximum(self.powderHits, calib)
+        self.updatePowder(calib, self.numPeaksFound >= self.minPeaks)
+
+    def updatePowder(self, calib, isHit):
+        """Adds calib to the powder of hits or misses in place.
+           The arrays are allocated on the first event, the maximum in float32 and the sum in float64
+        """
+        if self.powderHits is None:
+            self.powderHits = np.zeros(calib.shape, dtype=np.float32)
+            self.powderMisses = np.zeros(calib.shape, dtype=np.float32)
+            if self.powderMean:
+                self.powderHitsSum = np.zeros(calib.shape, dtype=np.float64)
+                self.powderMissesSum = np.zeros(calib.shape, dtype=np.float64)
+        if isHit:
+            powder, powderSum, numEvents = self.powderHits, self.powderHitsSum, self.numPowderHits
+            self.numPowderHits += 1
+        else:
+            powder, powderSum, numEvents = self.powderMisses, self.powderMissesSum, self.numPowderMisses
+            self.numPowderMisses += 1
+        if numEvents == 0:
+            np.copyto(powder, calib, casting='unsafe')
         else:
-            if self.powderMisses is None:
-                self.powderMisses = calib
-            else:
-                self.powderMisses = np.maximum(self.powderMisses, calib)
+            np.maximum(powder, calib, out=powder, casting='unsafe')
+        if powderSum is not None:
+            np.add(powderSum, calib, out=powderSum, casting='unsafe')
+
+    def addPowder(self, md):
+        """Adds the powder arrays and event counts to md, sent at the end of the run
+        """
+        md.small.powder = 1
+        md.addarray('powderHits', self.powderHits)
+        md.addarray('powderMisses', self.powderMisses)
+        if self.powderMean:
+            md.addarray('powderHitsSum', self.powderHitsSum)
+            md.addarray('powderMissesSum', self.powderMissesSum)
+            md.small.numPowderHits = self.numPowderHits
+            md.small.numPowderMisses = self.numPowderMisses
+
+def generousBadPixel(unassemMask, n=10):
+    generousBadPixelMask = unassemMask
+    (numAsic, numFs, numSs) = unassemMask.shape
+    for i in range(numAsic):
+        for a in range(numSs):
+            numBadPixels = len(np.where(unassemMask[i, :, a] == 0)[0])
+            if numBadPixels >= n:
+                generousBadPixelMask[i, :, a] = 0
+    return generousBadPixelMask
 
-        if self.powderHits is None: self.powderHits = np.zeros_like(calib)
-        if self.powderMisses is None: self.powderMisses = np.zeros_like(calib)
+def makeSharedArrays(detector, evt, userMask_path, psanaMask_on, psanaMask_calib, psanaMask_status, psanaMask_edges,
+                     psanaMask_central, psanaMask_unbond, psanaMask_unbondnrs, generousMask=0, streakMask_width=300):
+    """Returns the masks and pixel indices of a PeakFinder (LCLS), which only depend on the run.
+       The clients of a node compute them once and share them read-only, see nodeShared.py
+    """
+    userMask = None
+    psanaMask = None
+    # Make user mask
+    if userMask_path is not None:
+        userMask = np.load(userMask_path)
+    # Make psana mask
+    if str2bool(psanaMask_on):
+        psanaMask = detector.mask(evt, calib=str2bool(psanaMask_calib), status=str2bool(psanaMask_status),
+                                  edges=str2bool(psanaMask_edges), central=str2bool(psanaMask_central),
+                                  unbond=str2bool(psanaMask_unbond), unbondnbrs=str2bool(psanaMask_unbondnrs))
+        if generousMask:
+            psanaMask = generousBadPixel(psanaMask)
+    # Combine userMask and psanaMask
+    userPsanaMask = np.ones_like(detector.calib(evt), dtype=np.int16)
+    if userMask is not None:
+        userPsanaMask *= userMask
+    if psanaMask is not None:
+        userPsanaMask *= psanaMask
+    streakMask = myskbeam.StreakMask(detector, evt, width=streakMask_width)
+    iX = np.array(detector.indexes_x(evt), dtype=np.int64)
+    iY = np.array(detector.indexes_y(evt), dtype=np.int64)
+    if len(iX.shape) == 2:
+        iX = np.expand_dims(iX, axis=0)
+        iY = np.expand_dims(iY, axis=0)
+    return {'userMask': userMask, 'psanaMask': psanaMask, 'userPsanaMask': userPsanaMask, 'iX': iX, 'iY': iY,
+            'streakAssem': streakMask.assem, 'streakEdges': getattr(streakMask, 'imgEdges', None)}
 
 def getMaxRes(posX, posY, centerX, centerY):
     maxRes = np.max(np.sqrt((posX - centerX) ** 2 + (posY - centerY) ** 2))
@@ -6,8 +6,7 @@ from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.parametertree import Parameter, ParameterTree
 import LaunchPeakFinder
 import json, os, time
-from scipy.spatial.distance import cdist
-from scipy.spatial import distance
+from peakLikelihood import calculate_likelihood
 import subprocess
 
 if 'LCLS' in os.environ['PSOCAKE_FACILITY'].upper():
@@ -842,24 +841,12 @@ class PeakFinding(object):
 
                                     # Read in powder pattern and calculate pixel indices
                                     powderSum = np.load(powderSumFname)
-                                    powderSum1D = powderSum.ravel()
                                     cx, cy = self.parent.det.indexes_xy(self.parent.evt)
                                     ipx, ipy = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0))
-                                    r = np.sqrt((cx - ipx) ** 2 + (cy - ipy) ** 2).ravel().astype(int)
-                                    startR = 0
-                                    endR = np.max(r)
-                                    profile = np.zeros(endR - startR, )
-                                    for i, val in enumerate(np.arange(startR, endR)):
-                                        ind = np.where(r == val)[0].astype(int)
-                                        if len(ind) > 0: profile[i] = np.mean(powderSum1D[ind])
-                                    myThreshInd = np.argmax(profile)
+                                    myThreshInd, self.ind = myskbeam.getSolutionRing(powderSum, cx, cy, ipx, ipy)
                                     print "###################################################"
                                     print "Solution scattering radius (pixels): ", myThreshInd
                                     print "###################################################"
-                                    thickness = 10
-                                    indLo = np.where(r >= myThreshInd - thickness / 2.)[0].astype(int)
-                                    indHi = np.where(r <= myThreshInd + thickness / 2.)[0].astype(int)
-                                    self.ind = np.intersect1d(indLo, indHi)
 
                                     ix = self.parent.det.indexes_x(self.parent.evt)
                                     iy = self.parent.det.indexes_y(self.parent.evt)
@@ -944,7 +931,7 @@ class PeakFinding(object):
                     wavelength = 12.407002 / float(self.parent.photonEnergy)  # Angstrom
                     norm = np.sqrt(x ** 2 + y ** 2 + z ** 2)
                     qPeaks = (np.array([x, y, z]) / norm - np.array([[0.], [0.], [1.]])) / wavelength
-                    [meanClosestNeighborDist, self.pairsFoundPerSpot] = self.calculate_likelihood(qPeaks)
+                    [meanClosestNeighborDist, self.pairsFoundPerSpot] = calculate_likelihood(qPeaks)
                 else:
                     self.pairsFoundPerSpot = 0
                 if self.parent.args.v >= 1: print "Num peaks found: ", self.numPeaksFound, self.peaks.shape, self.pairsFoundPerSpot
@@ -962,38 +949,6 @@ class PeakFinding(object):
                 self.drawPeaks()
             if self.parent.args.v >= 1: print "Done updateClassification"
 
-    def calculate_likelihood(self, qPeaks):
-
-        nPeaks = int(qPeaks.shape[1])
-        selfD = distance.cdist(qPeaks.transpose(), qPeaks.transpose(), 'euclidean')
-        # sortedIndexD = np.argsort(selfD, axis = 1)
-        sortedSelfD = np.sort(selfD)
-        closestNeighborDist = sortedSelfD[:, 1]
-        meanClosestNeighborDist = np.median(closestNeighborDist)
-        numclosest = [0] * nPeaks
-        closestPeaks = [None] * nPeaks
-        coords = qPeaks.transpose()
-        pairsFound = 0.
-
-        for ii in range(nPeaks):
-            index = np.where(selfD[ii, :] == closestNeighborDist[ii])
-            # numclosest[ii] = index[0].shape[0]
-            closestPeaks[ii] = coords[list(index[0]), :].copy()
-            p = coords[ii, :]
-            flip = 2 * p - closestPeaks[ii]
-            d = distance.cdist(coords, flip, 'euclidean')
-            sigma = closestNeighborDist[ii] / 4.
-            mu = 0.
-            bins = d
-            vals = np.exp(-(bins - mu) ** 2 / (2. * sigma ** 2))
-            weight = np.sum(vals)
-            pairsFound += weight
-
-        pairsFound = pairsFound / 2.
-        pairsFoundPerSpot = pairsFound / float(nPeaks)
-
-        return [meanClosestNeighborDist, pairsFoundPerSpot]
-
     def convert_peaks_to_cheetah(self, s, r, c) :
         """Converts seg, row, col assuming (32,185,388)
            to cheetah 2-d table row and col (8*185, 4*388)
@@ -0,0 +1,97 @@
+"""EPICS variables sent with each event by the peak finder clients.
+
+Most EPICS variables (beam and laser settings, camera length) change slowly, so they are read once per
+calib cycle, and at most every refreshSeconds of run time, instead of at every event. Variables that are
+read per event (e.g. the timetool) use perEvent=True. Missing variables are sent as 0 and looked up again
+at the next read, in case they appear later in the run; each is only reported once.
+"""
+import numpy as np
+
+refreshSeconds = 10
+
+# (field name, EPICS variable, scale)
+beamPvs = [('pulseLength', 'SIOC:SYS0:ML00:AO820', 1),
+           ('ebeamCharge', 'BEND:DMP1:400:BDES', 1),
+           ('beamRepRate', 'EVNT:SYS0:1:LCLSBEAMRATE', 1),
+           ('particleN_electrons', 'BPMS:DMP1:199:TMIT1H', 1),
+           ('eVernier', 'SIOC:SYS0:ML00:AO289', 1),
+           ('charge', 'BEAM:LCLS:ELEC:Q', 1),
+           ('peakCurrentAfterSecondBunchCompressor', 'SIOC:SYS0:ML00:AO195', 1),
+           ('ebeamEnergyLossConvertedToPhoton_mJ', 'SIOC:SYS0:ML00:AO569', 1),
+           ('calculatedNumberOfPhotons', 'SIOC:SYS0:ML00:AO580', 1e12), # number of photons
+           ('photonBeamEnergy', 'SIOC:SYS0:ML00:AO541', 1),
+           ('wavelength', 'SIOC:SYS0:ML00:AO192', 1)]
+
+def getBeamPvs(args):
+    # Beam variables, and the camera length for the instruments that have one
+    pvs = list(beamPvs)
+    if "cxi" in args.exp or "mfx" in args.exp or "xpp" in args.exp:
+        pvs.append(('lclsDet', args.clen, 1)) # mm
+    return pvs
+
+def getLaserPvs(args):
+    return [('timeToolDelay', str(args.instrument) + ':LAS:MMN:04.RBV', 1),
+            ('laserTimeZero', 'LAS:FS5:VIT:FS_TGT_TIME_OFFSET', 1),
+            ('laserTimeDelay', 'LAS:FS5:VIT:FS_TGT_TIME_DIAL', 1),
+            ('laserTimePhaseLocked', 'LAS:FS5:VIT:PHASE_LOCKED', 1)]
+
+def getTimetoolPvs(args):
+    instrument = str(args.instrument)
+    return [('ttspecAmpl', instrument + ':TTSPEC:AMPL', 1),
+            ('ttspecAmplNxt', instrument + ':TTSPEC:AMPLNXT', 1),
+            ('ttspecFltPos', instrument + ':TTSPEC:FLTPOS', 1),
+            ('ttspecFltPosFwhm', instrument + ':TTSPEC:FLTPOSFWHM', 1),
+            ('ttspecFltPosPs', instrument + ':TTSPEC:FLTPOS_PS', 1),
+            ('ttspecRefAmpl', instrument + ':TTSPEC:REFAMPL', 1)]
+
+def getSteps(run, numEvents):
+    """Returns the calib cycle of each event of an indexed run, None if the run doesn't tell
+    """
+    try:
+        numStepEvents = [len(run.times(i)) for i in range(run.nsteps())]
+    except (AttributeError, TypeError):
+        return None
+    if sum(numStepEvents) != numEvents: return None
+    return np.repeat(np.arange(len(numStepEvents)), numStepEvents)
+
+class EpicsCache(object):
+    def __init__(self, ds, pvs, steps=None, perEvent=False):
+        """ds: data source, whose EPICS store holds the values of the last event read
+           pvs: list of (field name, EPICS variable, scale)
+           steps: calib cycle of each event number (see getSteps), None if unknown
+        """
+        self.ds = ds
+        self.pvs = pvs
+        self.steps = steps
+        self.perEvent = perEvent
+        self.key = None
+        self.values = {}
+        self.reported = set() # missing variables already reported
+
+    def get(self, nevent, sec):
+        """Returns a dict of the values of the variables for event number nevent at time sec
+        """
+        step = self.steps[nevent] if self.steps is not None else 0
+        key = (step, int(sec // refreshSeconds))
+        if self.perEvent or key != self.key:
+            self.read()
+            self.key = key
+        return self.values
+
+    def read(self):
+        es = self.ds.env().epicsStore()
+        missing = []
+        for name, pv, scale in self.pvs:
+            try:
+                value = es.value(pv)
+            except Exception:
+                value = None
+            if value is None:
+                if pv not in self.reported: missing.append(pv)
+                value = 0
+            elif scale != 1:
+                value = value * scale
+            self.values[name] = value
+        if missing:
+            print "EPICS variables not found, sent as 0: ", ", ".join(missing)
+            self.reported.update(missing)
@@ -0,0 +1,125 @@
+"""Per-run index of the events: event number, seconds, nanoseconds and fiducial.
+
+The index is made from run.times() the first time a run is accessed and saved to
+<indexDir>/.<exp>_<run>_events.npy. Later accesses memory-map the file, so counting events
+and looking up timestamps or fiducials don't need a psana DataSource.
+The names, sizes and modification times of the run's xtc files when the index was made are saved
+next to it (.<exp>_<run>_xtc.npy). The index is made again if they changed, e.g. if it was made while
+the run was still being copied, and it is not saved if the xtc files can't be found.
+Runs read from ffb may still be recorded, their index is never saved.
+"""
+import os, glob
+import numpy as np
+
+indexDtype = np.dtype([('event', '<i8'), ('sec', '<u4'), ('nsec', '<u4'), ('fiducial', '<u4')])
+
+xtcDir = '/reg/d/psdm'
+xtcDtype = np.dtype([('name', 'S128'), ('size', '<i8'), ('mtime', '<f8')])
+
+def getIndexFname(indexDir, exp, runNumber):
+    return os.path.join(indexDir, '.' + exp + '_' + str(runNumber).zfill(4) + '_events.npy')
+
+def getXtcFname(indexDir, exp, runNumber):
+    return os.path.join(indexDir, '.' + exp + '_' + str(runNumber).zfill(4) + '_xtc.npy')
+
+def getXtcFiles(exp, runNumber, dataDir=None):
+    # Name, size and modification time of the xtc files of the run
+    if dataDir is None: dataDir = xtcDir
+    fnames = glob.glob(dataDir + '/' + exp[:3] + '/' + exp + '/xtc/*-r' + str(runNumber).zfill(4) + '-*.xtc')
+    xtcFiles = np.zeros(len(fnames), dtype=xtcDtype)
+    for i, fname in enumerate(sorted(fnames)):
+        try:
+            st = os.stat(fname)
+        except OSError:
+            continue
+        xtcFiles[i] = (os.path.basename(fname), st.st_size, st.st_mtime)
+    return xtcFiles
+
+def isCurrent(indexDir, exp, runNumber, xtcFiles):
+    # True if the saved index was made from the same xtc files
+    fname = getXtcFname(indexDir, exp, runNumber)
+    if len(xtcFiles) == 0 or not os.path.exists(fname): return False
+    try:
+        saved = np.load(fname)
+    except (IOError, ValueError):
+        return False
+    return saved.dtype == xtcDtype and np.array_equal(saved, xtcFiles)
+
+def saveArray(fname, arr):
+    # Writes to a temporary file first, so that readers never see a partial file
+    tmpFname = fname + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmpFname, 'wb') as f:
+            np.save(f, arr)
+        os.rename(tmpFname, fname)
+    except (IOError, OSError):
+        if os.path.exists(tmpFname): os.remove(tmpFname)
+        return False
+    return True
+
+def makeEventIndex(times):
+    # times: psana event times of the run
+    index = np.zeros(len(times), dtype=indexDtype)
+    index['event'] = np.arange(len(times))
+    index['sec'] = [t.seconds() for t in times]
+    index['nsec'] = [t.nanoseconds() for t in times]
+    index['fiducial'] = [t.fiducial() for t in times]
+    return index
+
+def getEventIndex(exp, runNumber, indexDir, access='ana', run=None, dataDir=None):
+    """Returns the event index of the run, memory-mapped if it was saved to indexDir from the current xtc files.
+       Otherwise it is made from run (or a new psana DataSource) and saved to indexDir if possible.
+       dataDir: directory of the experiments (default xtcDir)
+    """
+    fname = getIndexFname(indexDir, exp, runNumber)
+    isLive = 'ffb' in access.lower()
+    if not isLive:
+        # Taken before the index is made, so files still growing don't match next time
+        xtcFiles = getXtcFiles(exp, runNumber, dataDir)
+        if os.path.exists(fname) and isCurrent(indexDir, exp, runNumber, xtcFiles):
+            return np.load(fname, mmap_mode='r')
+    if run is None:
+        import psana
+        _access = 'exp=' + str(exp) + ':run=' + str(runNumber) + ':idx'
+        if isLive: _access += ':dir=/reg/d/ffb/' + exp[:3] + '/' + exp + '/xtc'
+        run = psana.DataSource(_access).runs().next()
+    index = makeEventIndex(run.times())
+    if isLive or len(xtcFiles) == 0: return index
+    if not saveArray(fname, index): return index
+    saveArray(getXtcFname(indexDir, exp, runNumber), xtcFiles)
+    return np.load(fname, mmap_mode='r')
+
+class eventLookup(object):
+    """Events of an index hashed by fiducial, made once per index.
+       Fiducials wrap around every few minutes, so a fiducial can have several events,
+       which are told apart by their timestamp
+    """
+    def __init__(self, index):
+        self.byFiducial = {}
+        for event, sec, nsec, fid in np.asarray(index).tolist():
+            self.byFiducial.setdefault(fid, []).append((sec, nsec, event))
+
+    def findFiducial(self, fid):
+        # Returns (sec, nsec, event) of the events with fiducial fid
+        return self.byFiducial.get(fid, [])
+
+    def findEvent(self, sec, nsec, fid):
+        # Returns the event number with timestamp sec, nsec and fiducial fid, None if there is none
+        for _sec, _nsec, event in self.findFiducial(fid):
+            if _sec == sec and _nsec == nsec: return event
+        return None
+
+class eventTimes(object):
+    """psana event times of the events of an index, made on access.
+       Can be used in place of run.times()
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        import psana
+        event, sec, nsec, fiducial = self.index[i]
+        return psana.EventTime(int(sec) << 32 | int(nsec), int(fiducial))
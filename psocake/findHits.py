@@ -1,10 +1,13 @@
 # Find pixels with photons
-from hitFinderMaster import runmaster
+from hitFinderMaster import runmaster, createShards, runcoordinator
 from hitFinderClient import runclient
 
 import h5py, psana
+import eventIndex
 import numpy as np
-from mpi4py import MPI
+from localmpi import MPI
+from nodeShared import getnodecomm
+from mpidata import setbatchsize, setsendbuffers, setmaster, getaggregator, getnumclients
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
@@ -34,30 +37,39 @@ parser.add_argument("--psanaMask_unbond",help="psana unbonded pixels on",default
 parser.add_argument("--psanaMask_unbondnrs",help="psana unbonded pixel neighbors on",default="False", type=str)
 parser.add_argument("-v","--verbose",help="verbosity of output for debugging, 1=print, 2=print+plot",default=0, type=int)
 parser.add_argument("--localCalib", help="use local calib directory, default=False", action='store_true')
+parser.add_argument("--chunkSize", help="number of events handed out to a client at a time", default=10, type=int)
+parser.add_argument("--batchSize", help="number of events a client packs into one message to the master, 1 to disable", default=16, type=int)
+parser.add_argument("--sendBuffers", help="number of messages a client can have in flight to the master, 0 for blocking sends", default=2, type=int)
+parser.add_argument("--flushEvents", help="flush the cxi file every N events, 0 to disable (see flushPolicy.py)", default=100, type=int)
+parser.add_argument("--flushSeconds", help="flush the cxi file every T seconds, 0 to disable (see flushPolicy.py)", default=10., type=float)
+parser.add_argument("--aggregators", help="number of sub-aggregator ranks, each writing a shard of the cxi file that is merged at the end, 0 to write from rank 0 only", default=0, type=int)
 args = parser.parse_args()
+assert args.aggregators >= 0 and size-1-args.aggregators >= max(1, args.aggregators), 'Each sub-aggregator requires at least one client rank'
 
-def getNoe(args):
-    runStr = "%04d" % args.run
-    ds = psana.DataSource("exp="+args.exp+":run="+runStr+':idx')
-    run = ds.runs().next()
-    times = run.times()
+def getNoe(args, index):
     # check if the user requested specific number of events
     if args.noe == -1:
-        numJobs = len(times)
+        numJobs = len(index)
     else:
-        if args.noe <= len(times):
+        if args.noe <= len(index):
             numJobs = args.noe
         else:
-            numJobs = len(times)
+            numJobs = len(index)
     return numJobs
 
 if args.localCalib: psana.setOption('psana.calib-dir','./calib')
 
+# Rank 0 reads the event index of the run once and broadcasts it to the other ranks
+runInfo = None
+if rank == 0:
+    runInfo = {'index': np.array(eventIndex.getEventIndex(args.exp, args.run, args.outDir))}
+runInfo = comm.bcast(runInfo, root=0)
+
 if rank == 0:
     runStr = "%04d" % args.run
     fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
     # Get number of events to process
-    numJobs = getNoe(args)
+    numJobs = getNoe(args, runInfo['index'])
 
     # Create hdf5 and save psana input
     myHdf5 = h5py.File(fname, 'w')
@@ -81,12 +93,24 @@ if rank == 0:
     myHdf5.create_dataset(grpName+dset_nHits, data=np.ones(numJobs,)*-1, dtype='int')
     myHdf5.flush()
     myHdf5.close()
+    if args.aggregators > 0: createShards(args, args.aggregators)
 
 comm.Barrier()
 
+# Clients on the same node share the masks (see nodeShared.py)
+clientComm = comm.Split(int(rank > args.aggregators), rank)
+
 if rank==0:
-    runmaster(args,numClients)
+    if args.aggregators > 0:
+        runcoordinator(args, args.aggregators)
+    else:
+        runmaster(args,numClients)
+elif rank <= args.aggregators:
+    runmaster(args, getnumclients(rank, args.aggregators), shard=rank)
 else:
-    runclient(args)
+    setmaster(getaggregator(rank, args.aggregators))
+    setbatchsize(args.batchSize)
+    setsendbuffers(args.sendBuffers)
+    runclient(args, getnodecomm(clientComm), runInfo)
 
 MPI.Finalize()
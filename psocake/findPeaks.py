@@ -1,11 +1,14 @@
 # Find Bragg peaks
-from peakFinderMaster import runmaster
+from peakFinderMaster import runmaster, resumeCxi, createShards, runcoordinator
 from peakFinderClientAuto import runclient as runclientAuto
 from peakFinderClient import runclient
+import myskbeam
 import h5py
 import glob
 import numpy as np
-from mpi4py import MPI
+from localmpi import MPI
+from nodeShared import getnodecomm
+from mpidata import setbatchsize, setsendbuffers, setflowcontrol, setmaster, getaggregator, getnumclients
 import os
 
 comm = MPI.COMM_WORLD
@@ -69,16 +72,28 @@ parser.add_argument("--pixelSize",help="pixel size",default=0, type=float)
 parser.add_argument("--minPeaks", help="Index only if above minimum number of peaks",default=15, type=int)
 parser.add_argument("--maxPeaks", help="Index only if below maximum number of peaks",default=2048, type=int)
 parser.add_argument("--minRes", help="Index only if above minimum resolution",default=0, type=int)
+parser.add_argument("--powderMean", help="also save the mean powder of hits and misses", action='store_true')
 parser.add_argument("--localCalib", help="Use local calib directory. A calib directory must exist in your current working directory.", action='store_true')
 parser.add_argument("--profile", help="Turn on profiling. Saves timing information for calibration, peak finding, and saving to hdf5", action='store_true')
 parser.add_argument("--cxiVersion", help="cxi version",default=140, type=int)
 parser.add_argument("--auto", help="automatically determine peak finding parameter per event", default="False", type=str)
+parser.add_argument("--writeQueueSize", help="maximum number of received events waiting to be written to the cxi file", default=1000, type=int)
+parser.add_argument("--chunkSize", help="number of events handed out to a client at a time", default=10, type=int)
+parser.add_argument("--batchSize", help="number of events a client packs into one message to the master, 1 to disable", default=16, type=int)
+parser.add_argument("--sendBuffers", help="number of messages a client can have in flight to the master, 0 for blocking sends", default=2, type=int)
+parser.add_argument("--hitCredits", help="number of hits (images) a client can have in flight to the master, 0 to disable flow control", default=4, type=int)
+parser.add_argument("--hitQueueBytes", help="memory a client can use to hold hits while waiting for credits (bytes)", default=2000000000, type=int)
+parser.add_argument("--flushEvents", help="flush the cxi file every N events, 0 to disable (see flushPolicy.py)", default=100, type=int)
+parser.add_argument("--flushSeconds", help="flush the cxi file every T seconds, 0 to disable (see flushPolicy.py)", default=10., type=float)
+parser.add_argument("--aggregators", help="number of sub-aggregator ranks, each writing a shard of the cxi file that is merged at the end (or by --resume if the run stopped), 0 to write from rank 0 only", default=0, type=int)
+parser.add_argument("--resume", help="resume from an existing cxi file, only processing events that are not done yet", action='store_true')
 # LCLS specific
 parser.add_argument("-a","--access", help="Set data node access: {ana,ffb}",default="ana", type=str)
 # PAL specific
 parser.add_argument("--dir", help="PAL directory where the detector images (hdf5) are stored", default=None, type=str)
 parser.add_argument("--currentRun", help="current run number", type=int)
 args = parser.parse_args()
+assert args.aggregators >= 0 and size-1-args.aggregators >= max(1, args.aggregators), 'Each sub-aggregator requires at least one client rank'
 
 def str2bool(v): return v.lower() in ("yes", "true", "t", "1")
 
@@ -94,9 +109,7 @@ def getNoe(args):
         access = "exp="+args.exp+":run="+runStr+':idx'
         if 'ffb' in args.access.lower(): access += ':dir=/reg/d/ffb/' + args.exp[:3] + '/' + args.exp + '/xtc'
         print "findPeaks: ", access
-        ds = psana.DataSource(access)
-        run = ds.runs().next()
-        times = run.times()
+        times = runInfo['index']
         # check if the user requested specific number of events
         if args.noe == -1:
             numJobs = len(times)
@@ -118,11 +131,32 @@ def getNoe(args):
 
 if args.localCalib: psana.setOption('psana.calib-dir','./calib')
 
-if rank == 0:
+# Rank 0 opens the run once and broadcasts the event index and the camera length to the other ranks
+runInfo = None
+if rank == 0 and facility == 'LCLS':
+    ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib, access=args.access)
+    ps.setupExperiment(indexDir=args.outDir)
+    runInfo = {'index': np.array(ps.eventIndex), 'clen': getattr(ps, 'clen', None)}
+    if str2bool(args.auto):
+        # Pixels of the solution scattering ring, used by the auto clients to set the thresholds of each event
+        powderSum = np.load(args.outDir + '/background.npy')
+        cx, cy = ps.det.indexes_xy(ps.evt)
+        ipx, ipy = ps.det.point_indexes(ps.evt, pxy_um=(0, 0))
+        radius, runInfo['solutionRing'] = myskbeam.getSolutionRing(powderSum, cx, cy, ipx, ipy)
+        print "###################################################"
+        print "Solution scattering radius (pixels): ", radius
+        print "###################################################"
+runInfo = comm.bcast(runInfo, root=0)
+
+# Resume only if there is a cxi file to resume from
+resumeRun = False
+if rank == 0 and args.resume:
+    resumeRun = os.path.exists(args.outDir + '/' + args.exp + "_" + "%04d" % args.run + ".cxi")
+    if not resumeRun: print "findPeaks: no cxi file to resume from, starting a new run"
+resumeRun = comm.bcast(resumeRun, root=0)
+
+if rank == 0 and not resumeRun:
     if facility == 'LCLS':
-        # Set up psana
-        ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib, access=args.access)
-        ps.setupExperiment()
         numEvents = ps.eventTotal
         img = None
         for i in np.arange(numEvents):
@@ -352,6 +386,9 @@ if rank == 0:
             myHdf5.create_dataset("/entry_1/result_1/reshapeTime", (0,), maxshape=(None,), dtype=float)
             myHdf5.create_dataset("/entry_1/result_1/totalTime", data=np.zeros(numJobs, ), dtype=float)
             myHdf5.create_dataset("/entry_1/result_1/rankID", data=np.zeros(numJobs, ), dtype=int)
+            myHdf5.create_dataset("/entry_1/result_1/queueDepth", data=np.zeros(numJobs, ), dtype=int)
+            myHdf5.create_dataset("/entry_1/result_1/writerLag", data=np.zeros(numJobs, ), dtype=float)
+            myHdf5.create_dataset("/entry_1/result_1/stallTime", data=np.zeros(numJobs, ), dtype=float)
             myHdf5.flush()
 
         ds_nPeaks = myHdf5.create_dataset("/entry_1/result_1/nPeaks",(0,),
@@ -533,6 +570,9 @@ if rank == 0:
             myHdf5.create_dataset("/entry_1/result_1/reshapeTime", (0,), maxshape=(None,), dtype=float)
             myHdf5.create_dataset("/entry_1/result_1/totalTime", data=np.zeros(numJobs, ), dtype=float)
             myHdf5.create_dataset("/entry_1/result_1/rankID", data=np.zeros(numJobs, ), dtype=int)
+            myHdf5.create_dataset("/entry_1/result_1/queueDepth", data=np.zeros(numJobs, ), dtype=int)
+            myHdf5.create_dataset("/entry_1/result_1/writerLag", data=np.zeros(numJobs, ), dtype=float)
+            myHdf5.create_dataset("/entry_1/result_1/stallTime", data=np.zeros(numJobs, ), dtype=float)
             myHdf5.flush()
 
         ds_nPeaks = myHdf5.create_dataset("/entry_1/result_1/nPeaks", (0,),
@@ -654,12 +694,30 @@ if rank == 0:
     # Close hdf5 file
     myHdf5.close()
 
+if rank == 0:
+    if resumeRun:
+        events = resumeCxi(args)
+        print "findPeaks: resuming with events left: ", len(events)
+    if args.aggregators > 0: createShards(args, args.aggregators)
+
 comm.Barrier()
 
+# Clients on the same node share the masks (see nodeShared.py)
+clientComm = comm.Split(int(rank > args.aggregators), rank)
+
 if rank==0:
-    runmaster(args, numClients)
+    if args.aggregators > 0:
+        runcoordinator(args, args.aggregators)
+    else:
+        runmaster(args, numClients)
+elif rank <= args.aggregators:
+    runmaster(args, getnumclients(rank, args.aggregators), shard=rank)
 else:
     print "Using auto peak finder: ", str2bool(args.auto)
-    runclientAuto(args)
+    setmaster(getaggregator(rank, args.aggregators))
+    setbatchsize(args.batchSize)
+    setsendbuffers(args.sendBuffers)
+    setflowcontrol(args.hitCredits, args.hitQueueBytes)
+    runclientAuto(args, getnodecomm(clientComm), runInfo)
 
 MPI.Finalize()
@@ -0,0 +1,73 @@
+"""Commit policy shared by the hdf5 writers of findPeaks, findHits and litPixels.
+
+Durability semantics:
+The writer only calls flush() on the hdf5 file every flushEvents events or every flushSeconds seconds,
+whichever comes first, and always at the end of the run. Sending SIGUSR1 to the writer process requests
+a flush at the next event. SIGTERM also requests a flush, after which the writer terminates the process,
+so the flush happens in the writer (with its buffered rows written) and not in the middle of a write.
+Writers check isDue() while waiting for messages too (polling instead of a blocking receive, which
+would not run the signal handlers), so requested and timed flushes also happen when no events arrive.
+Readers that open the file mid-run (e.g. the psocake GUI) only see the events up to the last flush.
+Per-event arrays (e.g. nPeaksAll, nHitsAll) keep their initial values for events received after
+the last flush, and hit datasets may be larger than the number of hits until the end of the run,
+when they are cropped. A crash loses at most the events received since the last flush.
+The status files (status_peaks.txt, status_hits.txt) are written at every flush.
+"""
+import time, signal, os
+
+class FlushPolicy:
+    def __init__(self, h5file, flushEvents=100, flushSeconds=10.):
+        """Set flushEvents or flushSeconds to 0 to disable flushing on number of events or time
+        """
+        self.h5file = h5file
+        self.flushEvents = flushEvents
+        self.flushSeconds = flushSeconds
+        self.numPending = 0
+        self.numFlushes = 0
+        self.lastFlush = time.time()
+        self.requested = False
+        self.terminating = None
+        self.oldHandlers = {}
+
+    def installSignalHandlers(self):
+        # Must be called from the main thread, as well as restoreSignalHandlers
+        self.oldHandlers[signal.SIGUSR1] = signal.signal(signal.SIGUSR1, self.requestFlush)
+        self.oldHandlers[signal.SIGTERM] = signal.signal(signal.SIGTERM, self.requestTerminate)
+
+    def restoreSignalHandlers(self):
+        for sig, handler in self.oldHandlers.items():
+            signal.signal(sig, handler)
+        self.oldHandlers = {}
+
+    def requestFlush(self, signum, frame):
+        self.requested = True
+
+    def requestTerminate(self, signum, frame):
+        # The writer terminates the process at its next flush
+        self.terminating = signum
+        self.requested = True
+
+    def terminate(self):
+        # Handlers can only be reset from the main thread, so exit with the status of the signal instead
+        os._exit(128 + self.terminating)
+
+    def update(self, numEvents=1):
+        """Counts events written since the last flush, returns True if a flush is due
+        """
+        self.numPending += numEvents
+        return self.isDue()
+
+    def isDue(self):
+        if self.requested: return True
+        if self.numPending == 0: return False
+        if self.flushEvents > 0 and self.numPending >= self.flushEvents: return True
+        if self.flushSeconds > 0 and time.time() - self.lastFlush >= self.flushSeconds: return True
+        return False
+
+    def flush(self):
+        self.h5file.flush()
+        self.numPending = 0
+        self.numFlushes += 1
+        self.lastFlush = time.time()
+        self.requested = False
+        if self.terminating is not None: self.terminate()
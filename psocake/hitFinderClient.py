@@ -1,25 +1,47 @@
 import psana
+import eventIndex
 import numpy as np
-from mpidata import mpidata 
+from mpidata import mpidata, workevents
+from nodeShared import sharearrays
 import HitFinder as hf
 import HitFinder_chiSquared as hfChi
 
-from mpi4py import MPI
+from localmpi import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-def runclient(args):
+def makeSharedArrays(args, run, times, d):
+    # Masks of the lit pixel hit finder, set up with the first event that has detector data
+    for t in times:
+        evt = run.event(t)
+        if d.calib(evt) is not None:
+            return hf.makeSharedArrays(d, evt, args.userMask_path, args.psanaMask_on, args.psanaMask_calib,
+                                       args.psanaMask_status, args.psanaMask_edges, args.psanaMask_central,
+                                       args.psanaMask_unbond, args.psanaMask_unbondnrs,
+                                       streakMask_width=args.streakMask_width)
+    return {}
+
+def runclient(args, nodeComm=None, runInfo=None):
+    """nodeComm: communicator of the clients on this node, which share the masks
+       runInfo: event index of the run, broadcast by rank 0
+    """
     ds = psana.DataSource("exp="+args.exp+":run="+str(args.run)+':idx')
     run = ds.runs().next()
     env = ds.env()
-    times = run.times()
+    if runInfo is not None:
+        times = eventIndex.eventTimes(runInfo['index'])
+    else:
+        times = run.times()
     d = psana.Detector(args.detectorName)
     d.do_reshape_2d_to_3d(flag=True)
 
-    for nevent in np.arange(len(times)):
-        if nevent == args.noe : break
-        if nevent%(size-1) != rank-1: continue # different ranks look at different events
+    # Masks are computed by one client per node and shared with the others
+    shared = None
+    if nodeComm is not None and args.algorithm == 2:
+        shared = sharearrays(nodeComm, lambda: makeSharedArrays(args, run, times, d)) or None
+
+    for nevent in workevents(): # events handed out by the master
         evt = run.event(times[nevent])
         detarr = d.calib(evt)
 
@@ -62,7 +84,8 @@ def runclient(args):
                                            psanaMask_edges=args.psanaMask_edges,
                                            psanaMask_central=args.psanaMask_central,
                                            psanaMask_unbond=args.psanaMask_unbond,
-                                           psanaMask_unbondnrs=args.psanaMask_unbondnrs)
+                                           psanaMask_unbondnrs=args.psanaMask_unbondnrs,
+                                           shared=shared)
         d.hitFinder.findHits(detarr,evt)
         md=mpidata()
         md.small.eventNum = nevent
@@ -1,54 +1,121 @@
-from mpi4py import MPI
+from localmpi import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
 import h5py, json
-from mpidata import mpidata
-import psana
+import numpy as np
+import os, shutil
+from mpidata import mpidata, workqueue
+from flushPolicy import FlushPolicy
 
 def writeStatus(fname,d):
     json.dump(d, open(fname, 'w'))
 
-def getNoe(args):
+def getNoe(fname):
+    # Number of events to process, set by findHits when it created the cxi file
+    f = h5py.File(fname, 'r')
+    numEvents = f["/entry_1/result_1/nHitsAll"].shape[0]
+    f.close()
+    return numEvents
+
+def getShardFname(args, shard):
     runStr = "%04d" % args.run
-    ds = psana.DataSource("exp="+args.exp+":run="+runStr+':idx')
-    run = ds.runs().next()
-    times = run.times()
-    # check if the user requested specific number of events
-    if args.noe == -1:
-        numJobs = len(times)
-    else:
-        if args.noe <= len(times):
-            numJobs = args.noe
-        else:
-            numJobs = len(times)
-    return numJobs
+    return args.outDir +"/"+ args.exp +"_"+ runStr + "_shard" + str(shard) + ".cxi"
 
-def runmaster(args,nClients):
+def createShards(args, numShards):
+    """Creates the shard files written by the sub-aggregators, as copies of the cxi file
+    """
+    runStr = "%04d" % args.run
+    fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
+    for shard in range(1, numShards + 1):
+        shutil.copyfile(fname, getShardFname(args, shard))
 
+def runcoordinator(args, numAggregators):
+    """Rank 0 with sub-aggregators: hands out work to the sub-aggregators and merges their shards
+    """
     runStr = "%04d" % args.run
     fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
     grpName = "/entry_1/result_1"
     dset_nHits = "/nHitsAll"
     statusFname = args.outDir + "/status_hits.txt"
 
+    numEvents = getNoe(fname)
+    writeStatus(statusFname, {"fracDone": 0.0})
+    work = workqueue(np.arange(numEvents), args.chunkSize, size - 1 - numAggregators)
+    nClients = numAggregators
+    while nClients > 0:
+        md = mpidata()
+        md.recv()
+        if md.small.endrun:
+            nClients -= 1
+        elif md.small.request:
+            md.sendwork(work.next())
+
+    # Merge the events processed by each shard
+    myHdf5 = h5py.File(fname, 'r+')
+    nHitsAll = myHdf5[grpName+dset_nHits].value
+    for shard in range(1, numAggregators + 1):
+        f = h5py.File(getShardFname(args, shard), 'r')
+        shardHits = f[grpName+dset_nHits].value
+        f.close()
+        nHitsAll[shardHits != -1] = shardHits[shardHits != -1]
+        os.remove(getShardFname(args, shard))
+    myHdf5[grpName+dset_nHits][...] = nHitsAll
+    if '/status/findHits' in myHdf5:
+        del myHdf5['/status/findHits']
+    myHdf5['/status/findHits'] = 'success'
+    myHdf5.flush()
+    myHdf5.close()
+    writeStatus(statusFname, {"fracDone": 100.0})
+
+def runmaster(args,nClients,shard=None):
+    """Receives events from nClients clients and writes them to the cxi file.
+       With a shard number, runs as a sub-aggregator writing its own shard and getting work from rank 0.
+    """
+    runStr = "%04d" % args.run
+    fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
+    grpName = "/entry_1/result_1"
+    dset_nHits = "/nHitsAll"
+    statusFname = args.outDir + "/status_hits.txt"
+    if shard is not None:
+        fname = getShardFname(args, shard)
+        statusFname = args.outDir + "/status_hits_shard" + str(shard) + ".txt"
+
     powderHits = None
     powderMisses = None
 
     numProcessed = 0
     fracDone = 0.0
-    numEvents = getNoe(args)
+    numEvents = getNoe(fname)
     d = {"fracDone": fracDone}
     writeStatus(statusFname, d)
 
     myHdf5 = h5py.File(fname, 'r+')
+    commit = FlushPolicy(myHdf5, flushEvents=args.flushEvents, flushSeconds=args.flushSeconds)
+    commit.installSignalHandlers()
+    # Clients request chunks of events to process, sub-aggregators pass requests on to rank 0
+    work = None
+    if shard is None: work = workqueue(np.arange(numEvents), args.chunkSize, nClients)
+    def flushIfDue():
+        # Also called while waiting for messages, so requested and timed flushes happen when idle
+        if commit.isDue():
+            commit.flush()
+            # Update status
+            fracDone = numProcessed * 100. / numEvents
+            d = {"fracDone": fracDone}
+            writeStatus(statusFname, d)
     while nClients > 0:
         # Remove client if the run ended
         md = mpidata()
-        md.recv()
+        md.recv(idle=flushIfDue)
         if md.small.endrun:
             nClients -= 1
+        elif md.small.request:
+            if work is not None:
+                md.sendwork(work.next())
+            else:
+                md.sendwork(mpidata().requestwork())
         #elif md.small.powder == 1:
         #    if powderHits is None:
         #        powderHits = md.powderHits
@@ -62,18 +129,20 @@ def runmaster(args,nClients):
             except:
                 continue
             myHdf5[grpName+dset_nHits][md.small.eventNum] = nPixels
-            myHdf5.flush()
             numProcessed += 1
-            # Update status
-            fracDone = numProcessed * 100. / numEvents
-            d = {"fracDone": fracDone}
-            writeStatus(statusFname, d)
+            commit.update()
+            flushIfDue()
+    commit.flush()
+    commit.restoreSignalHandlers()
 
     if '/status/findHits' in myHdf5:
         del myHdf5['/status/findHits']
     myHdf5['/status/findHits'] = 'success'
     myHdf5.flush()
     myHdf5.close()
+    if shard is not None:
+        md = mpidata()
+        md.endrun()
 
     # fnameHits = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxHits.npy"
     # fnameMisses = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxMisses.npy"
@@ -9,6 +9,7 @@ import argparse
 import time
 import os
 import socket
+from flushPolicy import FlushPolicy
 
 parser = argparse.ArgumentParser()
 parser.add_argument("exprun", help="psana experiment/run string (e.g. exp=xppd7114:run=43)", type=str)
@@ -20,10 +21,12 @@ parser.add_argument("-m","--mask",help="full path to binary mask numpy ndarray (
 parser.add_argument("-l","--litPixelThreshold",help="number of ADUs to be considered a lit pixel",default=100, type=float)
 parser.add_argument("-v","--verbose",help="verbosity of output for debugging, 1=print, 2=print+plot",default=0, type=int)
 parser.add_argument("--localCalib", help="use local calib directory, default=False", action='store_true')
+parser.add_argument("--flushEvents", help="flush the output file every N events, 0 to disable (see flushPolicy.py)", default=100, type=int)
+parser.add_argument("--flushSeconds", help="flush the output file every T seconds, 0 to disable (see flushPolicy.py)", default=10., type=float)
 args = parser.parse_args()
 assert os.path.isdir(args.outdir)
 
-from mpi4py import MPI
+from localmpi import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
@@ -325,9 +328,17 @@ def master():
             thisCoordsZ[...] = coordsZ
 
     # Receive results from slaves
+    commit = FlushPolicy(f, flushEvents=args.flushEvents, flushSeconds=args.flushSeconds)
+    commit.installSignalHandlers()
     status = MPI.Status()
     nevts = 0
     while slavecount:
+        # Wait for an event message, flushing while idle if a flush is requested or due
+        while not comm.Iprobe(source=MPI.ANY_SOURCE, tag=0):
+            if commit.isDue():
+                hitMetric_ds.attrs['numEvents'] = nevts
+                commit.flush()
+            time.sleep(0.001)
         # Receive event message (pickled object)
         smallMsg = comm.recv(source=MPI.ANY_SOURCE, tag=0, status=status)
         if smallMsg.done:
@@ -343,8 +354,12 @@ def master():
             evttime_ds[nevts] = (seconds << 32) | nanoseconds
             fids_ds[nevts] = fiducials
             hitMetric_ds[nevts] = hitMetric
-            f.flush()
             nevts+=1
+            if commit.update():
+                # Number of events readable so far
+                hitMetric_ds.attrs['numEvents'] = nevts
+                commit.flush()
+    commit.restoreSignalHandlers()
 
     # Save attributes
     hitMetric_ds.attrs['numEvents'] = nevts
@@ -0,0 +1,230 @@
+"""Local replacement for the mpi4py calls used by findPeaks, findHits and litPixels.
+
+Set PSOCAKE_LOCAL_PROCS to the number of processes to run a script on this host without MPI, e.g.
+    PSOCAKE_LOCAL_PROCS=8 python findPeaks.py -e cxic0415 -r 24 ...
+The first import of this module forks ranks 1 to N-1, which carry on running the script like MPI ranks,
+so runmaster/runclient and mpidata are unchanged. Each rank has a multiprocessing queue for its messages.
+Arrays of at least shmMinBytes (e.g. images) are not pickled: the sender writes them to a shared memory
+file and the receiver copies them out of it into the buffer passed to Recv, and unlinks it. This is not
+zero-copy, each array is copied once by the sender and once by the receiver, but it avoids pickling the
+array and pushing it through the queue's pipe.
+Without PSOCAKE_LOCAL_PROCS, MPI is mpi4py's MPI.
+"""
+import os, sys, time, mmap, signal, itertools, tempfile, Queue
+import cPickle as pickle
+import multiprocessing
+import numpy as np
+
+ANY_SOURCE = -1
+ANY_TAG = -1
+# Tags of the collective operations, not matched by ANY_TAG
+BCASTTAG = -2
+BARRIERTAG = -3
+SPLITTAG = -4
+COMM_TYPE_SHARED = 1 # all ranks run on this host
+shmMinBytes = 1 << 16
+shmDir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+COMM_WORLD = None
+children = [] # pids of ranks 1 to N-1 (rank 0)
+parent = None # pid of rank 0
+worldRank = 0
+inbox = None # queue of the messages to this rank, from any communicator
+stash = [] # messages received but not matched yet, in order of arrival
+shmCounter = itertools.count()
+
+class Status(object):
+    def __init__(self):
+        self.source = ANY_SOURCE
+        self.tag = ANY_TAG
+
+    def Get_source(self):
+        return self.source
+
+    def Get_tag(self):
+        return self.tag
+
+class Request(object):
+    # Messages are queued when they are sent, so there is nothing to wait for
+    def Wait(self):
+        pass
+
+    @staticmethod
+    def Waitall(requests):
+        pass
+
+class localcomm(object):
+    def __init__(self, commId, ranks, inboxes):
+        """ranks: world rank of each rank of the communicator
+        """
+        self.commId = commId
+        self.ranks = ranks
+        self.rank = ranks.index(worldRank)
+        self.size = len(ranks)
+        self.inboxes = inboxes
+        self.numSplits = 0
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def put(self, dest, tag, kind, payload):
+        self.inboxes[self.ranks[dest]].put((self.rank, tag, kind, payload, self.commId))
+
+    def ismatch(self, msg, source, tag):
+        if msg[4] != self.commId: return False
+        if source != ANY_SOURCE and msg[0] != source: return False
+        if tag == ANY_TAG: return msg[1] >= 0
+        return msg[1] == tag
+
+    def get(self, source, tag, block=True, remove=True):
+        """Returns the first message from source with tag, None if there is none and block is False
+        """
+        for i, msg in enumerate(stash):
+            if self.ismatch(msg, source, tag):
+                if remove: del stash[i]
+                return msg
+        while True:
+            try:
+                msg = inbox.get(block, 1.)
+            except Queue.Empty:
+                if not block: return None
+                checkranks()
+                continue
+            if self.ismatch(msg, source, tag):
+                if not remove: stash.append(msg)
+                return msg
+            stash.append(msg)
+
+    def send(self, obj, dest, tag=0):
+        self.put(dest, tag, 'obj', pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def isend(self, obj, dest, tag=0):
+        self.send(obj, dest, tag)
+        return Request()
+
+    def recv(self, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        msg = self.get(source, tag)
+        if status is not None:
+            status.source, status.tag = msg[0], msg[1]
+        return pickle.loads(msg[3])
+
+    def Iprobe(self, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        msg = self.get(source, tag, block=False, remove=False)
+        if msg is not None and status is not None:
+            status.source, status.tag = msg[0], msg[1]
+        return msg is not None
+
+    def Send(self, buf, dest, tag=0):
+        arr = np.ascontiguousarray(buf)
+        if arr.nbytes < shmMinBytes:
+            self.put(dest, tag, 'buf', arr.tostring())
+            return
+        fname = os.path.join(shmDir, 'psocake_%d_%d_%d' % (parent, worldRank, shmCounter.next()))
+        with open(fname, 'wb') as f:
+            arr.tofile(f)
+        self.put(dest, tag, 'shm', fname)
+
+    def Isend(self, buf, dest, tag=0):
+        self.Send(buf, dest, tag)
+        return Request()
+
+    def Recv(self, buf, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        msg = self.get(source, tag)
+        if status is not None:
+            status.source, status.tag = msg[0], msg[1]
+        out = buf.reshape(-1).view(np.uint8)
+        if msg[2] == 'buf':
+            out[...] = np.frombuffer(msg[3], dtype=np.uint8)
+            return
+        with open(msg[3], 'rb') as f:
+            shm = mmap.mmap(f.fileno(), out.nbytes, access=mmap.ACCESS_READ)
+            out[...] = np.frombuffer(shm, dtype=np.uint8)
+            shm.close()
+        os.remove(msg[3])
+
+    def bcast(self, obj, root=0):
+        if self.rank == root:
+            for r in range(self.size):
+                if r != root: self.send(obj, r, BCASTTAG)
+            return obj
+        return self.recv(root, BCASTTAG)
+
+    def Barrier(self):
+        if self.rank == 0:
+            for r in range(1, self.size):
+                self.recv(r, BARRIERTAG)
+            for r in range(1, self.size):
+                self.send(None, r, BARRIERTAG)
+        else:
+            self.send(None, 0, BARRIERTAG)
+            self.recv(0, BARRIERTAG)
+
+    def Split(self, color=0, key=0):
+        """Returns the communicator of the ranks with the same color, ordered by key
+        """
+        self.numSplits += 1
+        if self.rank == 0:
+            colors = [(color, key, self.ranks[0])]
+            for r in range(1, self.size):
+                colors.append(self.recv(r, SPLITTAG))
+        else:
+            self.send((color, key, worldRank), 0, SPLITTAG)
+            colors = None
+        colors = self.bcast(colors)
+        ranks = [r for c, k, r in sorted(colors, key=lambda x: (x[1], x[2])) if c == color]
+        return localcomm((self.commId, self.numSplits, color), ranks, self.inboxes)
+
+    def Split_type(self, splitType, key=0):
+        return self.Split(0, key)
+
+def checkranks():
+    """Called while waiting for a message: rank 0 stops all ranks if one of them failed,
+       the other ranks exit if rank 0 is gone
+    """
+    if worldRank != 0:
+        if os.getppid() != parent: os._exit(1)
+        return
+    for pid in list(children):
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done == 0: continue
+        children.remove(pid)
+        if status != 0:
+            for other in children:
+                os.kill(other, signal.SIGTERM)
+            raise RuntimeError('Local rank with pid %d exited with status %d' % (pid, status))
+
+def Finalize():
+    # Rank 0 waits for the other ranks to finish
+    sys.stdout.flush()
+    while children:
+        os.waitpid(children.pop(), 0)
+
+def init(numProcs):
+    """Forks ranks 1 to numProcs-1, the calling process is rank 0
+    """
+    global COMM_WORLD, parent, inbox, worldRank
+    assert numProcs > 0, 'PSOCAKE_LOCAL_PROCS must be at least 1'
+    parent = os.getpid()
+    inboxes = [multiprocessing.Queue() for r in range(numProcs)]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    rank = 0
+    for r in range(1, numProcs):
+        pid = os.fork()
+        if pid == 0:
+            rank = r
+            del children[:]
+            break
+        children.append(pid)
+    worldRank = rank
+    inbox = inboxes[rank]
+    COMM_WORLD = localcomm(0, range(numProcs), inboxes)
+
+if 'PSOCAKE_LOCAL_PROCS' in os.environ:
+    init(int(os.environ['PSOCAKE_LOCAL_PROCS']))
+    MPI = sys.modules[__name__]
+else:
+    from mpi4py import MPI
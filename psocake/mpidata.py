@@ -1,9 +1,186 @@
 import numpy as np
-from mpi4py import MPI
+import time, Queue
+from collections import deque
+from localmpi import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
+# Tags of messages from the master to the clients
+WORKTAG = 32000
+CREDITTAG = 32001
+# Rank the client sends to, rank 0 or the client's sub-aggregator (see setmaster)
+master = 0
+
+# Clients pack up to batchSize events into one batch message (see mpibatch)
+batchSize = 1
+maxBatchBytes = 1 << 20 # events with larger arrays (e.g. images) are sent on their own
+batch = None   # events waiting to be sent (client side)
+pending = deque() # events received in a batch but not returned by recv yet (master side)
+# Clients send with Isend from a pool of reusable buffers, one per message in flight (see sendslot)
+slots = []
+nextSlot = 0
+# Flow control of hit messages (events with an image), see setflowcontrol
+window = 0
+credits = 0
+maxHeldBytes = 0
+held = deque() # hits waiting for a credit (client side)
+heldBytes = 0
+stallTime = 0.0 # time spent waiting for credits since the last call to getstalltime
+
+def setmaster(r):
+    global master
+    master = r
+
+def getaggregator(r,numAggregators):
+    """Returns the rank that rank r sends its results to. With numAggregators > 0, ranks 1 to numAggregators
+       are sub-aggregators sending to rank 0 and the other ranks are split among them
+    """
+    if numAggregators == 0 or r <= numAggregators: return 0
+    return 1 + (r - numAggregators - 1) % numAggregators
+
+def getnumclients(r,numAggregators):
+    # Number of ranks sending their results to rank r
+    return sum(1 for i in range(1,size) if i != r and getaggregator(i,numAggregators) == r)
+
+def setbatchsize(n):
+    global batchSize
+    batchSize = max(1,n)
+
+def setsendbuffers(n):
+    """Number of messages a client can have in flight, 0 for blocking sends
+    """
+    global slots, nextSlot
+    waitsends()
+    slots = [sendslot() for i in range(max(0,n))]
+    nextSlot = 0
+
+class sendslot(object):
+    """Reusable send buffer. The arrays of a message are copied into it,
+       so the caller can reuse its arrays while the message is in flight
+    """
+    def __init__(self):
+        self.buf = np.empty(0,dtype=np.uint8)
+        self.requests = []
+
+    def wait(self):
+        if self.requests: MPI.Request.Waitall(self.requests)
+        self.requests = []
+
+    def post(self,obj,arrays):
+        self.wait()
+        offsets = []
+        numBytes = 0
+        for arr in arrays:
+            offsets.append(numBytes)
+            numBytes += (arr.nbytes + 15) // 16 * 16 # keep the copies aligned
+        if self.buf.nbytes < numBytes:
+            self.buf = np.empty(numBytes,dtype=np.uint8)
+        self.requests.append(comm.isend(obj,dest=master,tag=rank))
+        for arr, pos in zip(arrays,offsets):
+            copy = self.buf[pos:pos+arr.nbytes].view(arr.dtype).reshape(arr.shape)
+            copy[...] = arr
+            self.requests.append(comm.Isend(copy,dest=master,tag=rank))
+
+def postmsg(obj,arrays):
+    # Sends a pickled object followed by its arrays, without blocking if there are free send buffers
+    global nextSlot
+    if len(slots) == 0:
+        comm.send(obj,dest=master,tag=rank)
+        for arr in arrays:
+            comm.Send(np.ascontiguousarray(arr),dest=master,tag=rank)
+        return
+    slots[nextSlot].post(obj,arrays)
+    nextSlot = (nextSlot + 1) % len(slots)
+
+def waitsends():
+    for slot in slots:
+        slot.wait()
+
+def setflowcontrol(numCredits,queueBytes):
+    """A client can have numCredits hit messages in flight to the master, which returns a credit
+       once the hit is written. Without credits, hits are held by the client up to queueBytes
+       and the client only stalls beyond that. numCredits=0 disables flow control.
+    """
+    global window, credits, maxHeldBytes
+    window = max(0,numCredits)
+    credits = window
+    maxHeldBytes = queueBytes
+
+def ishit(md):
+    for info in md.small.arrayinfolist:
+        if info.name == 'data': return True
+    return False
+
+def pollcredits(block=False):
+    global credits
+    if block:
+        comm.recv(source=master,tag=CREDITTAG)
+        credits += 1
+    while comm.Iprobe(source=master,tag=CREDITTAG):
+        comm.recv(source=master,tag=CREDITTAG)
+        credits += 1
+
+def sendheld():
+    global credits, heldBytes
+    while held and credits > 0:
+        md = held.popleft()
+        heldBytes -= sum(arr.nbytes for arr in md.arraylist)
+        credits -= 1
+        postmsg(md.small,md.arraylist)
+
+def holdhit(md):
+    # Sends a hit when a credit is available, holds it otherwise, stalls only if too many bytes are held
+    global heldBytes, stallTime
+    held.append(md)
+    heldBytes += sum(arr.nbytes for arr in md.arraylist)
+    pollcredits()
+    sendheld()
+    if heldBytes > maxHeldBytes:
+        tic = time.time()
+        while heldBytes > maxHeldBytes:
+            pollcredits(block=True)
+            sendheld()
+        stallTime += time.time() - tic
+
+def flushheld():
+    # Sends the held hits and waits for the credits of all hits in flight, so none is left unreceived
+    global stallTime
+    tic = time.time()
+    while held:
+        pollcredits(block=True)
+        sendheld()
+    while credits < window:
+        pollcredits(block=True)
+    stallTime += time.time() - tic
+
+def getstalltime():
+    # Returns the time spent waiting for credits since the last call
+    global stallTime
+    t = stallTime
+    stallTime = 0.0
+    return t
+
+class creditmanager(object):
+    """Master side of the flow control: the writer releases the credit of a hit once it is written,
+       the receiving thread returns released credits to the clients
+    """
+    def __init__(self,enabled):
+        self.enabled = enabled
+        self.released = Queue.Queue()
+        self.ended = set()
+
+    def release(self,md):
+        if self.enabled and hasattr(md,'data'): self.released.put(md.recvRank)
+
+    def sendcredits(self):
+        while True:
+            try:
+                clientRank = self.released.get_nowait()
+            except Queue.Empty:
+                return
+            if clientRank not in self.ended: comm.send(1,dest=clientRank,tag=CREDITTAG)
+
 class arrayinfo(object):
     def __init__(self,name,array):
         self.name = name
@@ -14,6 +191,7 @@ class small(object):
     def __init__(self):
         self.arrayinfolist = []
         self.endrun = False
+        self.request = False
     def addarray(self,name,array):
         self.arrayinfolist.append(arrayinfo(name,array))
 
@@ -24,28 +202,174 @@ class mpidata(object):
         self.arraylist = []
 
     def endrun(self):
+        flushbatch()
+        flushheld()
+        waitsends()
         self.small.endrun = True
-        comm.send(self.small,dest=0,tag=rank)
+        comm.send(self.small,dest=master,tag=rank)
+
+    def requestwork(self):
+        # Asks the master for the next chunk of event numbers, an empty chunk means no work is left
+        assert rank!=master
+        self.small.request = True
+        comm.send(self.small,dest=master,tag=rank)
+        return comm.recv(source=master,tag=WORKTAG)
+
+    def sendwork(self,chunk):
+        # Answers a work request received by recv
+        comm.send(chunk,dest=self.recvRank,tag=WORKTAG)
 
     def addarray(self,name,array):
         self.arraylist.append(array)
         self.small.addarray(name,array)
 
     def send(self):
-        assert rank!=0
-        comm.send(self.small,dest=0,tag=rank)
+        assert rank!=master
+        global batch
         for arr in self.arraylist:
             assert arr.flags['C_CONTIGUOUS']
-            comm.Send(arr,dest=0,tag=rank)
+        if window > 0 and ishit(self):
+            holdhit(self)
+            return
+        if batchSize > 1:
+            layout = getlayout(self)
+            if layout is not None:
+                if batch is not None and batch.layout != layout: flushbatch()
+                if batch is None: batch = mpibatch(layout)
+                batch.add(self)
+                if len(batch.events) >= batchSize: flushbatch()
+                return
+            flushbatch() # keep events in order
+        postmsg(self.small,self.arraylist)
+
+    def recv(self,idle=None):
+        """idle: called repeatedly while waiting for a message
+        """
+        if len(pending) == 0:
+            if idle is not None:
+                while not comm.Iprobe(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG):
+                    idle()
+                    time.sleep(0.001)
+            self.recvmsg()
+            if not hasattr(self.small,'batch'): return
+            pending.extend(unpackbatch(self))
+        self.__dict__.update(pending.popleft().__dict__)
 
-    def recv(self):
-        assert rank==0
-        status=MPI.Status()       
+    def recvmsg(self):
+        status=MPI.Status()
         self.small=comm.recv(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG,status=status)
         recvRank = status.Get_source()
-        if not self.small.endrun:
+        self.recvRank = recvRank
+        if hasattr(self.small,'batch'):
+            self.records = np.empty(self.small.numEvents,dtype=self.small.descr)
+            comm.Recv(self.records,source=recvRank,tag=MPI.ANY_TAG)
+            self.counts = np.empty((len(self.small.arrays),self.small.numEvents),dtype=np.int64)
+            comm.Recv(self.counts,source=recvRank,tag=MPI.ANY_TAG)
+            self.buffers = []
+            for i, (name, dtype, shape) in enumerate(self.small.arrays):
+                buf = np.empty((self.counts[i].sum(),)+shape,dtype=dtype)
+                comm.Recv(buf,source=recvRank,tag=MPI.ANY_TAG)
+                self.buffers.append(buf)
+        elif not self.small.endrun:
             for arrinfo in self.small.arrayinfolist:
                 if not hasattr(self,arrinfo.name) or arr.shape!=arrinfo.shape or arr.dtype!=arrinfo.dtype:
                     setattr(self,arrinfo.name,np.empty(arrinfo.shape,dtype=arrinfo.dtype))
                 arr = getattr(self,arrinfo.name)
                 comm.Recv(arr,source=recvRank,tag=MPI.ANY_TAG)
+
+def isscalar(val):
+    return isinstance(val,(bool,int,long,float,np.bool_,np.integer,np.floating))
+
+def getlayout(md):
+    """Returns the fixed layout (scalar fields and arrays) used to batch an event,
+       or None if the event has to be sent on its own (pickled)
+    """
+    fields = []
+    for key, val in sorted(md.small.__dict__.items()):
+        if key in ('arrayinfolist','endrun','request'): continue
+        if not isscalar(val): return None
+        if isinstance(val,(bool,np.bool_)):
+            fields.append((key,'?'))
+        elif isinstance(val,(int,long,np.integer)):
+            fields.append((key,'<i8'))
+        else:
+            fields.append((key,'<f8'))
+    arrays = []
+    numBytes = 0
+    for info, arr in zip(md.small.arrayinfolist,md.arraylist):
+        if arr.ndim == 0: return None
+        numBytes += arr.nbytes
+        arrays.append((info.name,arr.dtype.str,arr.shape[1:]))
+    if numBytes > maxBatchBytes: return None
+    return (tuple(fields),tuple(arrays))
+
+class mpibatch(object):
+    """Events sharing one layout, sent as a record array of the scalars
+       and one concatenated buffer per array name, with the number of rows of each event
+    """
+    def __init__(self,layout):
+        self.layout = layout
+        self.events = []
+
+    def add(self,md):
+        self.events.append(md)
+
+    def send(self):
+        fields, arrays = self.layout
+        header = small()
+        header.batch = True
+        header.descr = list(fields)
+        header.numEvents = len(self.events)
+        header.arrays = list(arrays)
+        records = np.empty(len(self.events),dtype=header.descr)
+        for i, md in enumerate(self.events):
+            records[i] = tuple(getattr(md.small,key) for key, _ in fields)
+        counts = np.array([[md.arraylist[j].shape[0] for md in self.events] for j in range(len(arrays))],dtype=np.int64).reshape((len(arrays),len(self.events)))
+        bufs = [np.concatenate([md.arraylist[j] for md in self.events]) for j in range(len(arrays))]
+        postmsg(header,[records,counts]+bufs)
+
+def flushbatch():
+    global batch
+    if batch is not None and len(batch.events) > 0: batch.send()
+    batch = None
+
+def unpackbatch(msg):
+    """Returns the events of a received batch as mpidata objects
+    """
+    events = []
+    offsets = np.zeros((len(msg.small.arrays),msg.small.numEvents+1),dtype=np.int64)
+    offsets[:,1:] = np.cumsum(msg.counts,axis=1)
+    for i in range(msg.small.numEvents):
+        md = mpidata()
+        for key in msg.records.dtype.names:
+            setattr(md.small,key,msg.records[key][i].item())
+        for j, (name, dtype, shape) in enumerate(msg.small.arrays):
+            setattr(md,name,msg.buffers[j][offsets[j,i]:offsets[j,i+1]])
+        md.recvRank = msg.recvRank
+        events.append(md)
+    return events
+
+class workqueue(object):
+    """Hands out chunks of event numbers to the clients on request (master side).
+       Chunks shrink towards the end of the run so that all clients finish at about the same time.
+    """
+    def __init__(self,events,chunkSize,nClients):
+        self.events = np.asarray(events)
+        self.chunkSize = max(1,chunkSize)
+        self.nClients = max(1,nClients)
+        self.pos = 0
+
+    def next(self):
+        numLeft = len(self.events) - self.pos
+        n = max(1,min(self.chunkSize,numLeft//self.nClients))
+        chunk = self.events[self.pos:self.pos+n]
+        self.pos += len(chunk)
+        return chunk
+
+def workevents():
+    # Yields the event numbers handed out by the master until no work is left (client side)
+    while True:
+        chunk = mpidata().requestwork()
+        if len(chunk) == 0: return
+        for nevent in chunk:
+            yield nevent
@@ -1,7 +1,7 @@
 from scipy import signal as sg
 import numpy as np
 from skimage.morphology import h_maxima
-from skimage.measure import label, regionprops
+from skimage.measure import label
 import time
 
 # Donut mask
@@ -18,74 +18,122 @@ def donutMask(N,M,R,r,centreRow=0,centreCol=0):
     centreRow  - center in y
     centreCol  - center in x
     """
-    if centreRow == 0:
-        centerY = N/2.-0.5
-    if centreCol == 0:
-        centerX = M/2.-0.5
-    mask = np.zeros((N,M))
-    radialDistRow = np.zeros((N,M))
-    radialDistCol = np.zeros((N,M))
-    myN = np.zeros((N,M))
-    myM = np.zeros((N,M))
-    for i in range(N):
-        xDist = i-centerY
-        xDistSq = xDist**2
-        for j in range(M):
-            yDist = j-centerX
-            yDistSq = yDist**2
-            rSq = xDistSq+yDistSq
-            if rSq < R**2 and rSq >= r**2:
-                mask[i,j] = 1
-                radialDistRow[i,j] = xDist
-                radialDistCol[i,j] = yDist
-                myN[i,j] = i
-                myM[i,j] = j
+    centerY = N/2.-0.5 if centreRow == 0 else centreRow
+    centerX = M/2.-0.5 if centreCol == 0 else centreCol
+    rows = np.arange(N, dtype=float)[:, np.newaxis]
+    cols = np.arange(M, dtype=float)[np.newaxis, :]
+    xDist = rows-centerY
+    yDist = cols-centerX
+    rSq = xDist**2+yDist**2
+    good = (rSq < R**2) & (rSq >= r**2)
+    mask = good.astype(float)
+    radialDistRow = np.where(good, xDist, 0.)
+    radialDistCol = np.where(good, yDist, 0.)
+    myN = np.where(good, rows, 0.)
+    myM = np.where(good, cols, 0.)
     return mask, radialDistRow, radialDistCol, myN, myM
 
+# Ring indices by (innerRing, outerRing), see getRingIndices
+ringCache = {}
+
+def getRingIndices(innerRing, outerRing):
+    """
+    Returns lh, rh, fgInd, bgInd of a droplet with radius innerRing and background up to outerRing.
+    Computed once per (innerRing, outerRing), the index arrays are shared and read-only.
+
+    lh, rh - extent of the (2*outerRing+1)^2 box around the peak, left and right of its centre
+    fgInd  - indices of the box within innerRing (signal)
+    bgInd  - indices of the box between innerRing and outerRing (background)
+    """
+    key = (innerRing, outerRing)
+    if key not in ringCache:
+        width = int(outerRing * 2 + 1)
+        outer, rr, rc, n, m = donutMask(width, width, outerRing, innerRing, centreRow=0, centreCol=0)
+        inner, rr, rc, n, m = donutMask(width, width, innerRing, 0, centreRow=0, centreCol=0)
+        if width % 2 == 0:
+            lh = rh = int(width / 2)
+        else:
+            lh = int(width / 2)
+            rh = int(width / 2) + 1
+        fgInd = np.where(inner == 1)
+        bgInd = np.where(outer == 1)
+        for ind in fgInd + bgInd:
+            ind.flags.writeable = False
+        ringCache[key] = (lh, rh, fgInd, bgInd)
+    return ringCache[key]
+
+def getLabelCentroids(ll):
+    """
+    Returns the row and column centroids of labels 1 to ll.max() of a label image, in label order.
+    """
+    numLabels = int(ll.max())
+    rows, cols = np.nonzero(ll)
+    labels = ll[rows, cols]
+    counts = np.bincount(labels, minlength=numLabels+1)[1:]
+    x = np.bincount(labels, weights=rows, minlength=numLabels+1)[1:] / counts
+    y = np.bincount(labels, weights=cols, minlength=numLabels+1)[1:] / counts
+    return x, y
+
+def getDropletStats(calib, x, y, lh, rh, fgInd, bgInd, thr):
+    """
+    Returns numPix, tot, snr of the droplets centred at x, y in a 2-d calib, all droplets at once.
+    The signal and background are the pixels at fgInd and bgInd (see getRingIndices) of the box around each droplet.
+    Droplets whose pixels are not all within calib get 0.
+
+    numPix - number of signal pixels above thr
+    tot    - sum of the signal minus the mean background of each pixel
+    snr    - mean signal over the standard deviation of the background, -1 if it is 0
+    """
+    numPeaks = len(x)
+    numPix = np.zeros((numPeaks,))
+    tot = np.zeros((numPeaks,))
+    snr = np.zeros((numPeaks,))
+    row0 = x.astype(int) - lh
+    col0 = y.astype(int) - lh
+    boxRows = np.concatenate((fgInd[0], bgInd[0]))
+    boxCols = np.concatenate((fgInd[1], bgInd[1]))
+    maxRow = boxRows.max() if len(boxRows) else 0
+    maxCol = boxCols.max() if len(boxCols) else 0
+    good = (row0 >= 0) & (col0 >= 0) & (row0 + maxRow < calib.shape[0]) & (col0 + maxCol < calib.shape[1])
+    row0 = row0[good, np.newaxis]
+    col0 = col0[good, np.newaxis]
+    sig = calib[row0 + fgInd[0], col0 + fgInd[1]]
+    bg = calib[row0 + bgInd[0], col0 + bgInd[1]]
+    meanSig = np.mean(sig, axis=1)
+    stdNoise = np.std(bg, axis=1)
+    meanBackground = np.mean(bg, axis=1)
+    tot[good] = np.sum(sig, axis=1) - len(fgInd[0]) * meanBackground
+    numPix[good] = np.sum(sig >= thr, axis=1)
+    snr[good] = np.divide(meanSig, stdNoise, out=-np.ones_like(meanSig), where=(stdNoise != 0))
+    return numPix, tot, snr
+
+def getSolutionRing(powderSum, cx, cy, ipx, ipy, thickness=10):
+    """
+    Returns the radius of the solution scattering ring in pixels, where the radial profile of powderSum peaks,
+    and the flat indices of the pixels within thickness/2 of it.
+
+    cx, cy   - pixel coordinates of powderSum (e.g. det.indexes_xy)
+    ipx, ipy - beam centre (e.g. det.point_indexes)
+    """
+    r = np.sqrt((cx - ipx) ** 2 + (cy - ipy) ** 2).ravel().astype(int)
+    endR = np.max(r)
+    # Mean of each radius below endR, 0 if it has no pixels
+    numPix = np.bincount(r, minlength=endR+1)[:endR]
+    profile = np.bincount(r, weights=np.ravel(powderSum), minlength=endR+1)[:endR] / np.maximum(numPix, 1)
+    radius = np.argmax(profile)
+    ind = np.flatnonzero(np.abs(r - radius) <= thickness / 2.)
+    return radius, ind
+
 def findPeaks_hdome(calib, npix_min=0, npix_max=0, atot_thr=0,
               son_min=0, hvalue=0, r0=0, dr=0, mask=None):
     hmax = h_maxima(calib, hvalue)
     if mask is not None: hmax = np.multiply(hmax, mask)
 
     ll = label(hmax)
-    regions = regionprops(ll)
-
-    numPeaks = len(regions)
-    x = np.zeros((numPeaks,))
-    y = np.zeros((numPeaks,))
-    for i, p in enumerate(regions):
-        x[i], y[i] = p.centroid
-
-    innerRing = r0
-    outerRing = dr
-    width = int(outerRing * 2 + 1)
-
-    outer, rr, rc, n, m = donutMask(width, width, outerRing, innerRing, centreRow=0, centreCol=0)
-    inner, rr, rc, n, m = donutMask(width, width, innerRing, 0, centreRow=0, centreCol=0)
-    if width % 2 == 0:
-        lh = rh = int(width / 2)
-    else:
-        lh = int(width / 2)
-        rh = int(width / 2) + 1
-
-    snr = np.zeros_like(x)
-    tot = np.zeros_like(x)
-    numPix = np.zeros_like(x)
-    numInner = len(np.where(inner == 1)[0])
-    for i in range(numPeaks):
-        d = calib[int(x[i]) - lh:int(x[i]) + rh, int(y[i]) - lh:int(y[i]) + rh]
-        try:
-            meanSig = np.mean(d[np.where(inner == 1)])
-            stdNoise = np.std(d[np.where(outer == 1)])
-            meanBackground = np.mean(d[np.where(outer == 1)])
-            tot[i] = np.sum(d[np.where(inner == 1)]) - numInner * meanBackground
-            numPix[i] = len(np.where(d[np.where(inner == 1)] >= hvalue)[0])
-            if stdNoise == 0:
-                snr[i] = -1
-            else:
-                snr[i] = meanSig / stdNoise
-        except:
-            snr[i] = 0
+    x, y = getLabelCentroids(ll)
+
+    lh, rh, fgInd, bgInd = getRingIndices(r0, dr)
+    numPix, tot, snr = getDropletStats(calib, x, y, lh, rh, fgInd, bgInd, hvalue)
 
     ind= (snr >= son_min) & (tot >= atot_thr) & (numPix >= npix_min) & (numPix < npix_max)
     x = x[ind]
@@ -108,18 +156,7 @@ class DropletA:
     def __init__(self, innerRing, outerRing):
         self.innerRing = innerRing
         self.outerRing = outerRing
-        width = int(self.outerRing * 2 + 1)
-
-        outer, rr, rc, n, m = donutMask(width, width, self.outerRing, self.innerRing, centreRow=0, centreCol=0)
-        inner, rr, rc, n, m = donutMask(width, width, self.innerRing, 0, centreRow=0, centreCol=0)
-        if width % 2 == 0:
-            self.lh = self.rh = int(width / 2)
-        else:
-            self.lh = int(width / 2)
-            self.rh = int(width / 2) + 1
-
-        self.fgInd = np.where(inner == 1)
-        self.bgInd = np.where(outer == 1)
+        self.lh, self.rh, self.fgInd, self.bgInd = getRingIndices(self.innerRing, self.outerRing)
         #print "#skbeam fgInd: ", self.fgInd
 
     def findPeaks(self, calib, npix_min=0, npix_max=0, atot_thr=0, son_min=0, thr_low=0, thr_high=0, r0=0, dr=0, mask=None):
@@ -142,36 +179,12 @@ class DropletA:
         for j in range(numAsic):
             if numDim == 2:
                 ll = label(hmax)
+                asic = calib
             elif numDim == 3:
                 ll = label(hmax[j])
-            regions = regionprops(ll)
-            numPeaks = len(regions)
-            x = np.zeros((numPeaks,))
-            y = np.zeros((numPeaks,))
-            for i, p in enumerate(regions):
-                x[i], y[i] = p.centroid
-
-            snr = np.zeros_like(x)
-            tot = np.zeros_like(x)
-            numPix = np.zeros_like(x)
-            numInner = len(self.fgInd[0])
-            for i in range(numPeaks):
-                try:
-                    if numDim == 2:
-                        d = calib[int(x[i]) - self.lh:int(x[i]) + self.rh, int(y[i]) - self.lh:int(y[i]) + self.rh]
-                    elif numDim == 3:
-                        d = calib[j, int(x[i]) - self.lh:int(x[i]) + self.rh, int(y[i]) - self.lh:int(y[i]) + self.rh]
-                    meanSig = np.mean(d[self.fgInd])
-                    stdNoise = np.std(d[self.bgInd])
-                    meanBackground = np.mean(d[self.bgInd])
-                    tot[i] = np.sum(d[self.fgInd]) - numInner * meanBackground
-                    numPix[i] = len(np.where(d[self.fgInd] >= thr_low)[0])
-                    if stdNoise == 0:
-                        snr[i] = -1
-                    else:
-                        snr[i] = meanSig / stdNoise
-                except:
-                    snr[i] = 0
+                asic = calib[j]
+            x, y = getLabelCentroids(ll)
+            numPix, tot, snr = getDropletStats(asic, x, y, self.lh, self.rh, self.fgInd, self.bgInd, thr_low)
 
             ind= (snr >= son_min) & (tot >= atot_thr) & (numPix >= npix_min) & (numPix < npix_max)
             seg.append(np.ones_like(x[ind])*j)
@@ -202,18 +215,7 @@ class Droplet:
     def __init__(self, innerRing, outerRing):
         self.innerRing = innerRing
         self.outerRing = outerRing
-        width = int(self.outerRing * 2 + 1)
-
-        outer, rr, rc, n, m = donutMask(width, width, self.outerRing, self.innerRing, centreRow=0, centreCol=0)
-        inner, rr, rc, n, m = donutMask(width, width, self.innerRing, 0, centreRow=0, centreCol=0)
-        if width % 2 == 0:
-            self.lh = self.rh = int(width / 2)
-        else:
-            self.lh = int(width / 2)
-            self.rh = int(width / 2) + 1
-
-        self.fgInd = np.where(inner == 1)
-        self.bgInd = np.where(outer == 1)
+        self.lh, self.rh, self.fgInd, self.bgInd = getRingIndices(self.innerRing, self.outerRing)
 
     def findPeaks(self, calib, npix_min=0, npix_max=0, atot_thr=0, son_min=0, thr_low=0, thr_high=0, r0=0, dr=0, mask=None):
         hmax = np.zeros_like(calib)
@@ -221,32 +223,8 @@ class Droplet:
         if mask is not None: hmax = np.multiply(hmax, mask)
 
         ll = label(hmax)
-        regions = regionprops(ll)
-
-        numPeaks = len(regions)
-        x = np.zeros((numPeaks,))
-        y = np.zeros((numPeaks,))
-        for i, p in enumerate(regions):
-            x[i], y[i] = p.centroid
-
-        snr = np.zeros_like(x)
-        tot = np.zeros_like(x)
-        numPix = np.zeros_like(x)
-        numInner = len(self.fgInd[0])
-        for i in range(numPeaks):
-            try:
-                d = calib[int(x[i]) - self.lh:int(x[i]) + self.rh, int(y[i]) - self.lh:int(y[i]) + self.rh]
-                meanSig = np.mean(d[self.fgInd])
-                stdNoise = np.std(d[self.bgInd])
-                meanBackground = np.mean(d[self.bgInd])
-                tot[i] = np.sum(d[self.fgInd]) - numInner * meanBackground
-                numPix[i] = len(np.where(d[self.fgInd] >= thr_low)[0])
-                if stdNoise == 0:
-                    snr[i] = -1
-                else:
-                    snr[i] = meanSig / stdNoise
-            except:
-                snr[i] = 0
+        x, y = getLabelCentroids(ll)
+        numPix, tot, snr = getDropletStats(calib, x, y, self.lh, self.rh, self.fgInd, self.bgInd, thr_low)
 
         ind= (snr >= son_min) & (tot >= atot_thr) & (numPix >= npix_min) & (numPix < npix_max)
         x = x[ind]
@@ -271,44 +249,10 @@ def findPeaks(calib, npix_min=0, npix_max=0, atot_thr=0,
     if mask is not None: hmax = np.multiply(hmax, mask)
 
     ll = label(hmax)
-    regions = regionprops(ll)
-
-    numPeaks = len(regions)
-    x = np.zeros((numPeaks,))
-    y = np.zeros((numPeaks,))
-    for i, p in enumerate(regions):
-        x[i], y[i] = p.centroid
-
-    innerRing = r0
-    outerRing = dr
-    width = int(outerRing * 2 + 1)
-
-    outer, rr, rc, n, m = donutMask(width, width, outerRing, innerRing, centreRow=0, centreCol=0)
-    inner, rr, rc, n, m = donutMask(width, width, innerRing, 0, centreRow=0, centreCol=0)
-    if width % 2 == 0:
-        lh = rh = int(width / 2)
-    else:
-        lh = int(width / 2)
-        rh = int(width / 2) + 1
-
-    snr = np.zeros_like(x)
-    tot = np.zeros_like(x)
-    numPix = np.zeros_like(x)
-    numInner = len(np.where(inner == 1)[0])
-    for i in range(numPeaks):
-        d = calib[int(x[i]) - lh:int(x[i]) + rh, int(y[i]) - lh:int(y[i]) + rh]
-        try:
-            meanSig = np.mean(d[np.where(inner == 1)])
-            stdNoise = np.std(d[np.where(outer == 1)])
-            meanBackground = np.mean(d[np.where(outer == 1)])
-            tot[i] = np.sum(d[np.where(inner == 1)]) - numInner * meanBackground
-            numPix[i] = len(np.where(d[np.where(inner == 1)] >= pmin)[0])
-            if stdNoise == 0:
-                snr[i] = -1
-            else:
-                snr[i] = meanSig / stdNoise
-        except:
-            snr[i] = 0
+    x, y = getLabelCentroids(ll)
+
+    lh, rh, fgInd, bgInd = getRingIndices(r0, dr)
+    numPix, tot, snr = getDropletStats(calib, x, y, lh, rh, fgInd, bgInd, pmin)
 
     ind= (snr >= son_min) & (tot >= atot_thr) & (numPix >= npix_min) & (numPix < npix_max)
     x = x[ind]
@@ -373,11 +317,23 @@ def getStreakMask(det,evt):
     return fullMask
 
 class StreakMask:
-    def __init__(self, det, evt, width=300, sigma=1):
+    def __init__(self, det, evt, width=300, sigma=1, assem=None, imgEdges=None, calibShape=None):
+        """assem, imgEdges, calibShape: arrays of another StreakMask of the run, used instead of computing them
+        """
         self.det = det
         self.evt = evt
         self.width = width
         self.sigma = sigma
+        if assem is not None:
+            self.calibShape = tuple(calibShape)
+            self.calibSize = int(np.prod(calibShape))
+            (self.ix,self.iy) = det.point_indexes(evt)
+            self.halfWidth = int(width/2) # pixels
+            self.imgEdges = imgEdges
+            self.myInd = np.where(self.imgEdges==1)
+            self.assem = assem
+            self.setupCropIndex()
+            return
         calib = det.calib(evt)
         self.calibShape = calib.shape
         self.calibSize = calib.size
@@ -399,19 +355,26 @@ class StreakMask:
             a=np.arange(calib.size)+1
             a=a.reshape(calib.shape)
             self.assem=det.image(evt,a)
+            self.setupCropIndex()
         else:
             self.assem = None
 
+    def setupCropIndex(self):
+        """Calib index of each pixel of the cropped centre of the assembled image (once per geometry),
+           used to crop calib and to map the streak back to calib without assembling the whole image
+        """
+        crop = self.assem[self.ix-self.halfWidth:self.ix+self.halfWidth,self.iy-self.halfWidth:self.iy+self.halfWidth]
+        self.cropValid = crop > 0
+        self.cropCalibInd = np.maximum(crop.astype(np.int64) - 1, 0)
+
     def getStreakMaskCalib(self, evt, calib=None):
         if self.assem is not None:
 
-            if calib is not None:
-                img = self.det.image(evt, calib)
-            else:
-                img = self.det.image(evt)
+            if calib is None:
+                calib = self.det.calib(evt)
 
             # Crop centre of image
-            imgCrop = img[self.ix-self.halfWidth:self.ix+self.halfWidth,self.iy-self.halfWidth:self.iy+self.halfWidth]
+            imgCrop = np.where(self.cropValid, np.ravel(calib)[self.cropCalibInd], 0)
 
             # Blur image
             imgBlur=sg.convolve(imgCrop,np.ones((2,2)),mode='same')
@@ -428,22 +391,18 @@ class StreakMask:
             # Connected components
             myLabel = label(mask, neighbors=4, connectivity=1, background=0)
             # All pixels connected to edge pixels is masked out
-            myMask = np.ones_like(mask)
             myParts = np.unique(myLabel[self.myInd])
-            for i in myParts:
-                myMask[np.where(myLabel == i)] = 0
+            isEdgePart = np.zeros((myLabel.max()+1,), dtype=bool)
+            isEdgePart[myParts] = True
+            myMask = np.where(isEdgePart[myLabel], 0, 1)
 
             # Delete edges
             myMask[self.myInd]=1
             myMask[mySigInd]=0
 
             # Convert assembled to unassembled
-            wholeMask = np.ones_like(self.assem)
-            wholeMask[self.ix-self.halfWidth:self.ix+self.halfWidth,self.iy-self.halfWidth:self.iy+self.halfWidth] = myMask
-            pixInd = self.assem[np.where(wholeMask==0)]
-            pixInd = pixInd[np.nonzero(pixInd)]-1
             calibMask=np.ones((self.calibSize,))
-            calibMask[pixInd.astype(int)] = 0
+            calibMask[self.cropCalibInd[(myMask==0) & self.cropValid]] = 0
             calibMask=calibMask.reshape(self.calibShape)
 
             return calibMask
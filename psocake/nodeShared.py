@@ -0,0 +1,35 @@
+"""Arrays that only depend on the run (masks, pixel indices), shared by the client ranks of a node.
+
+The first client rank of a node computes the arrays and saves them to /dev/shm, the other client ranks
+of the node memory-map them read-only, so that the node holds one copy instead of one per rank.
+"""
+import os, shutil, tempfile
+import numpy as np
+from localmpi import MPI
+
+shmDir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def getnodecomm(comm):
+    # Communicator of the ranks of comm running on this node
+    return comm.Split_type(MPI.COMM_TYPE_SHARED)
+
+def sharearrays(nodeComm, compute):
+    """compute is only called on the first rank of the node and returns a dict of arrays (None values are skipped).
+       Returns the dict of read-only memory-mapped arrays on every rank of the node
+    """
+    dirname = None
+    names = []
+    if nodeComm.Get_rank() == 0:
+        dirname = tempfile.mkdtemp(prefix='psocake_', dir=shmDir)
+        for name, arr in compute().items():
+            if arr is None: continue
+            np.save(os.path.join(dirname, name + '.npy'), np.ascontiguousarray(arr))
+            names.append(name)
+    dirname, names = nodeComm.bcast((dirname, names), root=0)
+    shared = {}
+    for name in names:
+        shared[name] = np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+    nodeComm.Barrier()
+    # The mappings stay valid once the files are removed
+    if nodeComm.Get_rank() == 0: shutil.rmtree(dirname)
+    return shared
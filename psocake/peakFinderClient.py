@@ -1,8 +1,10 @@
 import numpy as np
-from mpidata import mpidata
+from mpidata import mpidata, workevents, getstalltime
 import time
 import os
 import PeakFinder as pf
+import eventIndex
+import epicsCache
 
 if 'LCLS' in os.environ['PSOCAKE_FACILITY'].upper():
     facility = 'LCLS'
@@ -11,22 +13,31 @@ elif 'PAL' in os.environ['PSOCAKE_FACILITY'].upper():
     facility = 'PAL'
     import glob, h5py
 
-from mpi4py import MPI
+from localmpi import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-def runclient(args):
+def runclient(args, runInfo=None):
+    """runInfo: event index and camera length of the run, broadcast by rank 0
+    """
     if facility == 'LCLS':
-        ds = psana.DataSource("exp="+args.exp+":run="+str(args.run)+':idx')
+        access = "exp="+args.exp+":run="+str(args.run)+':idx'
+        if 'ffb' in args.access.lower(): access += ':dir=/reg/d/ffb/' + args.exp[:3] + '/' + args.exp + '/xtc'
+        # One data source per client, shared with psanaWhisperer
+        ds = psana.DataSource(access)
         run = ds.runs().next()
         env = ds.env()
-        times = run.times()
-        d = psana.Detector(args.det)
-        d.do_reshape_2d_to_3d(flag=True)
-        ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib)
-        ps.setupExperiment()
+        if runInfo is not None:
+            times = eventIndex.eventTimes(runInfo['index'])
+        else:
+            times = run.times()
+        ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib, access=args.access)
+        ps.setupExperiment(ds=ds, run=run, times=times)
+        d = ps.det
         ebeamDet = psana.Detector('EBeam')
+        # EPICS variables are read once per calib cycle
+        beamEpics = epicsCache.EpicsCache(ds, epicsCache.getBeamPvs(args), epicsCache.getSteps(run, len(times)))
     elif facility == 'PAL':
         temp = args.dir + '/' + args.exp[:3] + '/' + args.exp + '/data/r' + str(args.run).zfill(4) + '/*.h5'
         _files = glob.glob(temp)
@@ -49,15 +60,14 @@ def runclient(args):
     if facility == 'LCLS':
         if hasCoffset:
             try:
-                detectorDistance = args.coffset + ps.clen * 1e-3  # sample to detector in m
+                clen = runInfo['clen'] if runInfo is not None else ps.clen
+                detectorDistance = args.coffset + clen * 1e-3  # sample to detector in m
             except:
                 detectorDistance = 0
         elif hasDetectorDistance:
             detectorDistance = args.detectorDistance
     
-    for nevent in np.arange(len(times)):
-        if nevent == args.noe : break
-        if nevent%(size-1) != rank-1: continue # different ranks look at different events
+    for nevent in workevents(): # events handed out by the master
 
         if args.profile: startTic = time.time()
 
@@ -75,7 +85,12 @@ def runclient(args):
 
         if args.profile: calibTime = time.time() - startTic # Time to calibrate per event
 
-        if detarr is None: continue
+        if detarr is None:
+            md = mpidata()
+            md.small.eventNum = nevent
+            md.small.powder = 0
+            md.send()
+            continue
 
         # Initialize hit finding
         if not hasattr(d,'peakFinder'):
@@ -106,6 +121,7 @@ def runclient(args):
                                               radialFilterOn=args.radialBackground,
                                               distance=args.detectorDistance,
                                               minNumPeaks=args.minPeaks,
+                                              powderMean=args.powderMean,
                                               maxNumPeaks=args.maxPeaks,
                                               minResCutoff=args.minRes,
                                               clen=args.clen,
@@ -140,6 +156,7 @@ def runclient(args):
                                               radialFilterOn=args.radialBackground,
                                               distance=args.detectorDistance,
                                               minNumPeaks=args.minPeaks,
+                                              powderMean=args.powderMean,
                                               maxNumPeaks=args.maxPeaks,
                                               minResCutoff=args.minRes,
                                               clen=args.clen,
@@ -161,83 +178,21 @@ def runclient(args):
 
         if facility == 'LCLS':
             # other cxidb data
-            ps.getEvent(nevent)
+            ps.evt = evt # epics store of the data source is at this event
 
-            es = ps.ds.env().epicsStore()
-            try:
-                pulseLength = es.value('SIOC:SYS0:ML00:AO820') * 1e-15  # s
-            except:
-                pulseLength = 0
+            evtId = ps.evt.get(psana.EventId)
+            md.small.sec = evtId.time()[0]
+            md.small.nsec = evtId.time()[1]
+            md.small.fid = evtId.fiducials()
 
-            md.small.pulseLength = pulseLength
+            # beam
+            for name, value in beamEpics.get(nevent, md.small.sec).items():
+                setattr(md.small, name, value)
 
             md.small.detectorDistance = detectorDistance
 
             md.small.pixelSize = args.pixelSize
 
-            # LCLS
-            if "cxi" in args.exp:
-                md.small.lclsDet = es.value(args.clen)  # mm
-            elif "mfx" in args.exp:
-                md.small.lclsDet = es.value(args.clen)  # mm
-            elif "xpp" in args.exp:
-                md.small.lclsDet = es.value(args.clen)  # mm
-
-            try:
-                md.small.ebeamCharge = es.value('BEND:DMP1:400:BDES')
-            except:
-                md.small.ebeamCharge = 0
-
-            try:
-                md.small.beamRepRate = es.value('EVNT:SYS0:1:LCLSBEAMRATE')
-            except:
-                md.small.beamRepRate = 0
-
-            try:
-                md.small.particleN_electrons = es.value('BPMS:DMP1:199:TMIT1H')
-            except:
-                md.small.particleN_electrons = 0
-
-            try:
-                md.small.eVernier = es.value('SIOC:SYS0:ML00:AO289')
-            except:
-                md.small.eVernier = 0
-
-            try:
-                md.small.charge = es.value('BEAM:LCLS:ELEC:Q')
-            except:
-                md.small.charge = 0
-
-            try:
-                md.small.peakCurrentAfterSecondBunchCompressor = es.value('SIOC:SYS0:ML00:AO195')
-            except:
-                md.small.peakCurrentAfterSecondBunchCompressor = 0
-
-            try:
-                md.small.pulseLength = es.value('SIOC:SYS0:ML00:AO820')
-            except:
-                md.small.pulseLength = 0
-
-            try:
-                md.small.ebeamEnergyLossConvertedToPhoton_mJ = es.value('SIOC:SYS0:ML00:AO569')
-            except:
-                md.small.ebeamEnergyLossConvertedToPhoton_mJ = 0
-
-            try:
-                md.small.calculatedNumberOfPhotons = es.value('SIOC:SYS0:ML00:AO580') * 1e12  # number of photons
-            except:
-                md.small.calculatedNumberOfPhotons = 0
-
-            try:
-                md.small.photonBeamEnergy = es.value('SIOC:SYS0:ML00:AO541')
-            except:
-                md.small.photonBeamEnergy = 0
-
-            try:
-                md.small.wavelength = es.value('SIOC:SYS0:ML00:AO192')
-            except:
-                md.small.wavelength = 0
-
             ebeam = ebeamDet.get(ps.evt)#.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
             try:
                 photonEnergy = ebeam.ebeamPhotonEnergy()
@@ -254,11 +209,6 @@ def runclient(args):
             md.small.photonEnergy = photonEnergy
             md.small.pulseEnergy = pulseEnergy
 
-            evtId = ps.evt.get(psana.EventId)
-            md.small.sec = evtId.time()[0]
-            md.small.nsec = evtId.time()[1]
-            md.small.fid = evtId.fiducials()
-
             if len(d.peakFinder.peaks) >= args.minPeaks and \
                len(d.peakFinder.peaks) <= args.maxPeaks and \
                d.peakFinder.maxRes >= args.minRes:
@@ -271,6 +221,7 @@ def runclient(args):
                 totalTime = time.time() - startTic
                 md.small.totalTime = totalTime
                 md.small.rankID = rank
+                md.small.stallTime = getstalltime() # waiting for hit credits
             md.send() # send mpi data object to master when desired
         elif facility == 'PAL':
             if len(d.peakFinder.peaks) >= args.minPeaks and \
@@ -284,16 +235,19 @@ def runclient(args):
                 totalTime = time.time() - startTic
                 md.small.totalTime = totalTime
                 md.small.rankID = rank
+                md.small.stallTime = getstalltime() # waiting for hit credits
             md.send()
         
     # At the end of the run, send the powder of hits and misses
     if facility == 'LCLS':
+        # Clients that got no image have no peak finder and only end the run, which the master waits for
         md = mpidata()
-        md.small.powder = 1
-        md.addarray('powderHits', d.peakFinder.powderHits)
-        md.addarray('powderMisses', d.peakFinder.powderMisses)
-        md.send()
-        md.endrun()
+        try:
+            if hasattr(d, 'peakFinder'):
+                d.peakFinder.addPowder(md)
+                md.send()
+        finally:
+            md.endrun()
     elif facility == 'PAL':
         print "powder hits and misses not implemented for PAL"
         md = mpidata()
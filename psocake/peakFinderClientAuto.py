@@ -1,11 +1,14 @@
 import numpy as np
-from mpidata import mpidata
+from mpidata import mpidata, workevents, getstalltime
+from nodeShared import sharearrays
 import time
 import os
 import PeakFinder as pf
-from scipy.spatial.distance import cdist
-from scipy.spatial import distance
+import myskbeam
+from peakLikelihood import calculate_likelihood
 import h5py
+import eventIndex
+import epicsCache
 
 if 'PSOCAKE_FACILITY' not in os.environ: os.environ['PSOCAKE_FACILITY'] = 'LCLS' # Default facility
 if 'LCLS' in os.environ['PSOCAKE_FACILITY'].upper():
@@ -15,14 +18,28 @@ elif 'PAL' in os.environ['PSOCAKE_FACILITY'].upper():
     facility = 'PAL'
     import glob, h5py
 
-from mpi4py import MPI
+from localmpi import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
 def str2bool(v): return v.lower() in ("yes", "true", "t", "1")
 
-def runclient(args):
+def makeSharedArrays(args, run, times, d):
+    # Masks and pixel indices of the peak finder, set up with the first event that has detector data
+    for t in times:
+        evt = run.event(t)
+        if d.calib(evt) is not None:
+            return pf.makeSharedArrays(d, evt, args.userMask_path, args.psanaMask_on, args.psanaMask_calib,
+                                       args.psanaMask_status, args.psanaMask_edges, args.psanaMask_central,
+                                       args.psanaMask_unbond, args.psanaMask_unbondnrs, generousMask=1,
+                                       streakMask_width=args.streakMask_width)
+    return {}
+
+def runclient(args, nodeComm=None, runInfo=None):
+    """nodeComm: communicator of the clients on this node, which share the masks and pixel indices
+       runInfo: event index, camera length and solution scattering ring (auto) of the run, broadcast by rank 0
+    """
     pairsFoundPerSpot = 0.0
     highSigma = 3.5
     lowSigma = 2.5
@@ -34,14 +51,17 @@ def runclient(args):
     if facility == 'LCLS':
         access = "exp="+args.exp+":run="+str(args.run)+':idx'
         if 'ffb' in args.access.lower(): access += ':dir=/reg/d/ffb/' + args.exp[:3] + '/' + args.exp + '/xtc'
+        # One data source per client, shared with psanaWhisperer and PeakFinder
         ds = psana.DataSource(access)
         run = ds.runs().next()
         env = ds.env()
-        times = run.times()
-        d = psana.Detector(args.det)
-        d.do_reshape_2d_to_3d(flag=True)
+        if runInfo is not None:
+            times = eventIndex.eventTimes(runInfo['index'])
+        else:
+            times = run.times()
         ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib, access=args.access)
-        ps.setupExperiment()
+        ps.setupExperiment(ds=ds, run=run, times=times)
+        d = ps.det
         ebeamDet = psana.Detector('EBeam')
         try:
             evr0 = psana.Detector('evr0')
@@ -51,6 +71,11 @@ def runclient(args):
             evr1 = psana.Detector('evr1')
         except:
             evr1 = None
+        # EPICS variables, slow ones are read once per calib cycle
+        steps = epicsCache.getSteps(run, len(times))
+        beamEpics = epicsCache.EpicsCache(ds, epicsCache.getBeamPvs(args), steps)
+        laserEpics = epicsCache.EpicsCache(ds, epicsCache.getLaserPvs(args), steps)
+        timetoolEpics = epicsCache.EpicsCache(ds, epicsCache.getTimetoolPvs(args), perEvent=True)
 
     elif facility == 'PAL':
         temp = args.dir + '/' + args.exp[:3] + '/' + args.exp + '/data/r' + str(args.run).zfill(4) + '/*.h5'
@@ -74,15 +99,19 @@ def runclient(args):
     if facility == 'LCLS':
         if hasCoffset:
             try:
-                detectorDistance = args.coffset + ps.clen * 1e-3  # sample to detector in m
+                clen = runInfo['clen'] if runInfo is not None else ps.clen
+                detectorDistance = args.coffset + clen * 1e-3  # sample to detector in m
             except:
                 detectorDistance = 0
         elif hasDetectorDistance:
             detectorDistance = args.detectorDistance
-    
-    for nevent in np.arange(len(times)):
-        if nevent == args.noe : break
-        if nevent%(size-1) != rank-1: continue # different ranks look at different events
+
+    # Masks and pixel indices are computed by one client per node and shared with the others
+    shared = None
+    if nodeComm is not None and facility == 'LCLS':
+        shared = sharearrays(nodeComm, lambda: makeSharedArrays(args, run, times, d)) or None
+
+    for nevent in workevents(): # events handed out by the master
 
         if args.profile: startTic = time.time()
 
@@ -102,7 +131,12 @@ def runclient(args):
 
         if args.profile: calibTime = time.time() - startTic # Time to calibrate per event
 
-        if detarr is None: continue
+        if detarr is None:
+            md = mpidata()
+            md.small.eventNum = nevent
+            md.small.powder = 0
+            md.send()
+            continue
 
         # Initialize hit finding
         if not hasattr(d,'peakFinder'):
@@ -135,11 +169,14 @@ def runclient(args):
                                                   radialFilterOn=args.radialBackground,
                                                   distance=args.detectorDistance,
                                                   minNumPeaks=args.minPeaks,
+                                                  powderMean=args.powderMean,
                                                   maxNumPeaks=args.maxPeaks,
                                                   minResCutoff=args.minRes,
                                                   clen=args.clen,
                                                   localCalib=args.localCalib,
-                                                  access=args.access)
+                                                  access=args.access,
+                                                  shared=shared,
+                                                  ps=ps)
                     else:
                         # Auto peak finder
                         d.peakFinder = pf.PeakFinder(exp, args.run, args.det, evt, d,
@@ -168,38 +205,28 @@ def runclient(args):
                                                      radialFilterOn=args.radialBackground,
                                                      distance=args.detectorDistance,
                                                      minNumPeaks=args.minPeaks,
+                                                     powderMean=args.powderMean,
                                                      maxNumPeaks=args.maxPeaks,
                                                      minResCutoff=args.minRes,
                                                      clen=args.clen,
                                                      localCalib=args.localCalib,
-                                                     access=args.access)
-                        # Read in powder pattern and calculate pixel indices
-                        powderSumFname = args.outDir + '/background.npy'
-                        powderSum = np.load(powderSumFname)
-                        powderSum1D = powderSum.ravel()
-                        cx, cy = d.indexes_xy(evt)
+                                                     access=args.access,
+                                                     shared=shared,
+                                                     ps=ps)
                         d.ipx, d.ipy = d.point_indexes(evt, pxy_um=(0, 0))
-                        r = np.sqrt((cx - d.ipx) ** 2 + (cy - d.ipy) ** 2).ravel().astype(int)
-                        startR = 0
-                        endR = np.max(r)
-                        profile = np.zeros(endR - startR, )
-                        for i, val in enumerate(np.arange(startR, endR)):
-                            ind = np.where(r == val)[0].astype(int)
-                            if len(ind) > 0:
-                                profile[i] = np.mean(powderSum1D[ind])
-                        myThreshInd = np.argmax(profile)
-                        print "###################################################"
-                        print "Solution scattering radius (pixels): ", myThreshInd
-                        print "###################################################"
-                        thickness = 10
-                        indLo = np.where(r >= myThreshInd - thickness / 2.)[0].astype(int)
-                        indHi = np.where(r <= myThreshInd + thickness / 2.)[0].astype(int)
-                        d.ind = np.intersect1d(indLo, indHi)
-
-                        ix = d.indexes_x(evt)
-                        iy = d.indexes_y(evt)
-                        d.iX = np.array(ix, dtype=np.int64)
-                        d.iY = np.array(iy, dtype=np.int64)
+                        if runInfo is not None and 'solutionRing' in runInfo:
+                            d.ind = runInfo['solutionRing']
+                        else:
+                            # Read in powder pattern and find the solution scattering ring
+                            powderSum = np.load(args.outDir + '/background.npy')
+                            cx, cy = d.indexes_xy(evt)
+                            myThreshInd, d.ind = myskbeam.getSolutionRing(powderSum, cx, cy, d.ipx, d.ipy)
+                            print "###################################################"
+                            print "Solution scattering radius (pixels): ", myThreshInd
+                            print "###################################################"
+
+                        d.iX = d.peakFinder.iX
+                        d.iY = d.peakFinder.iY
                 elif facility == 'PAL':
                     _geom = args.dir + '/' + args.exp[:3] + '/' + args.exp + '/scratch/' + os.environ['USER'] + \
                             '/psocake/r' + str(args.currentRun).zfill(4) + '/.temp.geom'
@@ -230,6 +257,7 @@ def runclient(args):
                                               radialFilterOn=args.radialBackground,
                                               distance=args.detectorDistance,
                                               minNumPeaks=args.minPeaks,
+                                              powderMean=args.powderMean,
                                               maxNumPeaks=args.maxPeaks,
                                               minResCutoff=args.minRes,
                                               clen=args.clen,
@@ -262,11 +290,14 @@ def runclient(args):
                                              radialFilterOn=args.radialBackground,
                                              distance=args.detectorDistance,
                                              minNumPeaks=args.minPeaks,
+                                             powderMean=args.powderMean,
                                              maxNumPeaks=args.maxPeaks,
                                              minResCutoff=args.minRes,
                                              clen=args.clen,
                                              localCalib=args.localCalib,
-                                             access=args.access)
+                                             access=args.access,
+                                             shared=shared,
+                                             ps=ps)
         if not str2bool(args.auto):
             if args.profile: tic = time.time()
 
@@ -334,70 +365,17 @@ def runclient(args):
 
         if facility == 'LCLS':
             # other cxidb data
-            ps.getEvent(nevent)
-
-            es = ps.ds.env().epicsStore()
-
-            # timetool
-            try:
-                md.small.timeToolDelay = es.value(args.instrument+':LAS:MMN:04.RBV')
-                if md.small.timeToolDelay is None: md.small.timeToolDelay = 0
-            except:
-                md.small.timeToolDelay = 0
-
-            try:
-                md.small.laserTimeZero = es.value('LAS:FS5:VIT:FS_TGT_TIME_OFFSET')
-                if md.small.laserTimeZero is None: md.small.laserTimeZero = 0
-            except:
-                md.small.laserTimeZero = 0
-
-            try:
-                md.small.laserTimeDelay = es.value('LAS:FS5:VIT:FS_TGT_TIME_DIAL')
-                if md.small.laserTimeDelay is None: md.small.laserTimeDelay = 0
-            except:
-                md.small.laserTimeDelay = 0
-
-            try:
-                md.small.laserTimePhaseLocked = es.value('LAS:FS5:VIT:PHASE_LOCKED')
-                if md.small.laserTimePhaseLocked is None: md.small.laserTimePhaseLocked = 0
-            except:
-                md.small.laserTimePhaseLocked = 0
-
-            try:
-                md.small.ttspecAmpl = es.value(args.instrument+':TTSPEC:AMPL')
-                if md.small.ttspecAmpl is None: md.small.ttspecAmpl = 0
-            except:
-                md.small.ttspecAmpl = 0
-
-            try:
-                md.small.ttspecAmplNxt = es.value(args.instrument+':TTSPEC:AMPLNXT')
-                if md.small.ttspecAmplNxt is None: md.small.ttspecAmplNxt = 0
-            except:
-                md.small.ttspecAmplNxt = 0
+            ps.evt = evt # epics store of the data source is at this event
 
-            try:
-                md.small.ttspecFltPos = es.value(args.instrument+':TTSPEC:FLTPOS')
-                if md.small.ttspecFltPos is None: md.small.ttspecFltPos = 0
-            except:
-                md.small.ttspecFltPos = 0
-
-            try:
-                md.small.ttspecFltPosFwhm = es.value(args.instrument+':TTSPEC:FLTPOSFWHM')
-                if md.small.ttspecFltPosFwhm is None: md.small.ttspecFltPosFwhm = 0
-            except:
-                md.small.ttspecFltPosFwhm = 0
-
-            try:
-                md.small.ttspecFltPosPs = es.value(args.instrument+':TTSPEC:FLTPOS_PS')
-                if md.small.ttspecFltPosPs is None: md.small.ttspecFltPosPs = 0
-            except:
-                md.small.ttspecFltPosPs = 0
+            evtId = ps.evt.get(psana.EventId)
+            md.small.sec = evtId.time()[0]
+            md.small.nsec = evtId.time()[1]
+            md.small.fid = evtId.fiducials()
 
-            try:
-                md.small.ttspecRefAmpl = es.value(args.instrument+':TTSPEC:REFAMPL')
-                if md.small.ttspecRefAmpl is None: md.small.ttspecRefAmpl = 0
-            except:
-                md.small.ttspecRefAmpl = 0
+            # timetool, laser and beam
+            for epics in [laserEpics, timetoolEpics, beamEpics]:
+                for name, value in epics.get(nevent, md.small.sec).items():
+                    setattr(md.small, name, value)
 
             if evr0:
                 ec = evr0.eventCodes(evt)
@@ -409,81 +387,10 @@ def runclient(args):
                 if ec is None: ec = [-1]
                 md.addarray('evr1', np.array(ec))
 
-            # pulse length
-            try:
-                pulseLength = es.value('SIOC:SYS0:ML00:AO820') * 1e-15  # s
-            except:
-                pulseLength = 0
-
-            md.small.pulseLength = pulseLength
-
             md.small.detectorDistance = detectorDistance
 
             md.small.pixelSize = args.pixelSize
 
-            # LCLS
-            if "cxi" in args.exp:
-                md.small.lclsDet = es.value(args.clen)  # mm
-            elif "mfx" in args.exp:
-                md.small.lclsDet = es.value(args.clen)  # mm
-            elif "xpp" in args.exp:
-                md.small.lclsDet = es.value(args.clen)  # mm
-
-            try:
-                md.small.ebeamCharge = es.value('BEND:DMP1:400:BDES')
-            except:
-                md.small.ebeamCharge = 0
-
-            try:
-                md.small.beamRepRate = es.value('EVNT:SYS0:1:LCLSBEAMRATE')
-            except:
-                md.small.beamRepRate = 0
-
-            try:
-                md.small.particleN_electrons = es.value('BPMS:DMP1:199:TMIT1H')
-            except:
-                md.small.particleN_electrons = 0
-
-            try:
-                md.small.eVernier = es.value('SIOC:SYS0:ML00:AO289')
-            except:
-                md.small.eVernier = 0
-
-            try:
-                md.small.charge = es.value('BEAM:LCLS:ELEC:Q')
-            except:
-                md.small.charge = 0
-
-            try:
-                md.small.peakCurrentAfterSecondBunchCompressor = es.value('SIOC:SYS0:ML00:AO195')
-            except:
-                md.small.peakCurrentAfterSecondBunchCompressor = 0
-
-            try:
-                md.small.pulseLength = es.value('SIOC:SYS0:ML00:AO820')
-            except:
-                md.small.pulseLength = 0
-
-            try:
-                md.small.ebeamEnergyLossConvertedToPhoton_mJ = es.value('SIOC:SYS0:ML00:AO569')
-            except:
-                md.small.ebeamEnergyLossConvertedToPhoton_mJ = 0
-
-            try:
-                md.small.calculatedNumberOfPhotons = es.value('SIOC:SYS0:ML00:AO580') * 1e12  # number of photons
-            except:
-                md.small.calculatedNumberOfPhotons = 0
-
-            try:
-                md.small.photonBeamEnergy = es.value('SIOC:SYS0:ML00:AO541')
-            except:
-                md.small.photonBeamEnergy = 0
-
-            try:
-                md.small.wavelength = es.value('SIOC:SYS0:ML00:AO192')
-            except:
-                md.small.wavelength = 0
-
             ebeam = ebeamDet.get(ps.evt)#.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
             try:
                 photonEnergy = md.small.photonBeamEnergy #ebeam.ebeamPhotonEnergy()
@@ -500,11 +407,6 @@ def runclient(args):
             md.small.photonEnergy = photonEnergy
             md.small.pulseEnergy = pulseEnergy
 
-            evtId = ps.evt.get(psana.EventId)
-            md.small.sec = evtId.time()[0]
-            md.small.nsec = evtId.time()[1]
-            md.small.fid = evtId.fiducials()
-
             if len(d.peakFinder.peaks) >= args.minPeaks and \
                len(d.peakFinder.peaks) <= args.maxPeaks and \
                d.peakFinder.maxRes >= args.minRes and \
@@ -518,6 +420,7 @@ def runclient(args):
                 totalTime = time.time() - startTic
                 md.small.totalTime = totalTime
                 md.small.rankID = rank
+                md.small.stallTime = getstalltime() # waiting for hit credits
             md.send() # send mpi data object to master when desired
         elif facility == 'PAL':
             if len(d.peakFinder.peaks) >= args.minPeaks and \
@@ -529,371 +432,16 @@ def runclient(args):
             md.small.photonEnergy = photonEnergy
             md.send()
 
-    ###############################
-    # Help your neighbor find peaks
-    ###############################
-    if facility == 'LCLS':
-        print "HELPER!!! ", rank
-        runStr = "%04d" % args.run
-        fname = args.outDir + "/" + args.exp + "_" + runStr + ".cxi"
-        dset_nPeaks = "/nPeaksAll"
-        grpName = "/entry_1/result_1"
-        try:
-            myHdf5 = h5py.File(fname, 'r')
-            nPeaksAll = myHdf5[grpName + dset_nPeaks].value
-            myHdf5.close()
-            ind = np.where(nPeaksAll == -1)[0]
-            numLeft = len(ind)
-
-            if numLeft > 0:
-                import numpy.random
-                ind = numpy.random.permutation(ind)
-
-                for nevent in ind:
-                    # check all done
-                    try:
-                        f = open(args.outDir+"/status_peaks.txt")
-                        line = f.readline()
-                        fracDone = float(line.split(',')[0].split(':')[-1])
-                        f.close()
-                        if fracDone >= 100:
-                            md = mpidata()
-                            md.small.eventNum = nevent
-                            md.small.powder = 0
-                            md.send()
-                            break
-                    except:
-                        pass
-
-                    if facility == 'LCLS':
-                        evt = run.event(times[nevent])
-                        detarr = d.calib(evt)
-                        exp = env.experiment()
-                        # run = evt.run()
-                    elif facility == 'PAL':
-                        f = h5py.File(_files[nevent], 'r')
-                        detarr = f['/data'].value
-                        f.close()
-                        exp = args.exp
-                        run = args.run
-
-                    if detarr is None:
-                        md = mpidata()
-                        md.small.eventNum = nevent
-                        md.small.powder = 0
-                        md.send()
-                        continue
-
-                    if not str2bool(args.auto):
-                        if args.profile: tic = time.time()
-
-                        d.peakFinder.findPeaks(detarr, evt)
-
-                        if args.profile: peakTime = time.time() - tic  # Time to find the peaks per event
-                    else:
-                        ################################
-                        # Determine thr_high and thr_low
-                        if args.profile: tic = time.time()
-
-                        calib1D = detarr.ravel()
-                        mean = np.mean(calib1D[d.ind])
-                        spread = np.std(calib1D[d.ind])
-                        thr_high = int(mean + highSigma * spread + 50)
-                        thr_low = int(mean + lowSigma * spread + 50)
-                        d.peakFinder.findPeaks(detarr, evt, thr_high, thr_low)
-
-                        if args.profile: peakTime = time.time() - tic  # Time to find the peaks per event
-
-                        # Likelihood
-                        numPeaksFound = d.peakFinder.peaks.shape[0]
-                        if numPeaksFound >= args.minPeaks and \
-                           numPeaksFound <= args.maxPeaks and \
-                           d.peakFinder.maxRes >= args.minRes:
-                            cenX = d.iX[np.array(d.peakFinder.peaks[:, 0], dtype=np.int64),
-                                           np.array(d.peakFinder.peaks[:, 1], dtype=np.int64),
-                                           np.array(d.peakFinder.peaks[:, 2], dtype=np.int64)] + 0.5
-                            cenY = d.iY[np.array(d.peakFinder.peaks[:, 0], dtype=np.int64),
-                                           np.array(d.peakFinder.peaks[:, 1], dtype=np.int64),
-                                           np.array(d.peakFinder.peaks[:, 2], dtype=np.int64)] + 0.5
-
-                            x = cenX - d.ipx  # args.center[0]
-                            y = cenY - d.ipy  # args.center[1]
-
-                            pixSize = float(d.pixel_size(evt))
-                            detdis = float(args.detectorDistance)
-                            z = detdis / pixSize * np.ones(x.shape)  # pixels
-
-                            ebeam = ebeamDet.get(evt)
-                            try:
-                                photonEnergy = ebeam.ebeamPhotonEnergy()
-                            except:
-                                photonEnergy = 1
-
-                            wavelength = 12.407002 / float(photonEnergy)  # Angstrom
-                            norm = np.sqrt(x ** 2 + y ** 2 + z ** 2)
-                            qPeaks = (np.array([x, y, z]) / norm - np.array([[0.], [0.], [1.]])) / wavelength
-                            [meanClosestNeighborDist, pairsFoundPerSpot] = calculate_likelihood(qPeaks)
-                        else:
-                            pairsFoundPerSpot = 0.0
-
-                    md = mpidata()
-                    md.addarray('peaks', d.peakFinder.peaks)
-                    md.small.eventNum = nevent
-                    md.small.maxRes = d.peakFinder.maxRes
-                    md.small.powder = 0
-                    if str2bool(args.auto):
-                        md.small.likelihood = pairsFoundPerSpot
-
-                    if args.profile:
-                        md.small.calibTime = calibTime
-                        md.small.peakTime = peakTime
-
-                    if facility == 'LCLS':
-                        # other cxidb data
-                        ps.getEvent(nevent)
-
-                        es = ps.ds.env().epicsStore()
-
-                        # timetool
-                        try:
-                            md.small.timeToolDelay = es.value(args.instrument+':LAS:MMN:04.RBV')
-                            if md.small.timeToolDelay is None: md.small.timeToolDelay = 0
-                        except:
-                            md.small.timeToolDelay = 0
-
-                        try:
-                            md.small.laserTimeZero = es.value('LAS:FS5:VIT:FS_TGT_TIME_OFFSET')
-                            if md.small.laserTimeZero is None: md.small.laserTimeZero = 0
-                        except:
-                            md.small.laserTimeZero = 0
-
-                        try:
-                            md.small.laserTimeDelay = es.value('LAS:FS5:VIT:FS_TGT_TIME_DIAL')
-                            if md.small.laserTimeDelay is None: md.small.laserTimeDelay = 0
-                        except:
-                            md.small.laserTimeDelay = 0
-
-                        try:
-                            md.small.laserTimePhaseLocked = es.value('LAS:FS5:VIT:PHASE_LOCKED')
-                            if md.small.laserTimePhaseLocked is None: md.small.laserTimePhaseLocked = 0
-                        except:
-                            md.small.laserTimePhaseLocked = 0
-
-                        try:
-                            md.small.ttspecAmpl = es.value(args.instrument + ':TTSPEC:AMPL')
-                            if md.small.ttspecAmpl is None: md.small.ttspecAmpl = 0
-                        except:
-                            md.small.ttspecAmpl = 0
-
-                        try:
-                            md.small.ttspecAmplNxt = es.value(args.instrument + ':TTSPEC:AMPLNXT')
-                            if md.small.ttspecAmplNxt is None: md.small.ttspecAmplNxt = 0
-                        except:
-                            md.small.ttspecAmplNxt = 0
-
-                        try:
-                            md.small.ttspecFltPos = es.value(args.instrument + ':TTSPEC:FLTPOS')
-                            if md.small.ttspecFltPos is None: md.small.ttspecFltPos = 0
-                        except:
-                            md.small.ttspecFltPos = 0
-
-                        try:
-                            md.small.ttspecFltPosFwhm = es.value(args.instrument + ':TTSPEC:FLTPOSFWHM')
-                            if md.small.ttspecFltPosFwhm is None: md.small.ttspecFltPosFwhm = 0
-                        except:
-                            md.small.ttspecFltPosFwhm = 0
-
-                        try:
-                            md.small.ttspecFltPosPs = es.value(args.instrument + ':TTSPEC:FLTPOS_PS')
-                            if md.small.ttspecFltPosPs is None: md.small.ttspecFltPosPs = 0
-                        except:
-                            md.small.ttspecFltPosPs = 0
-
-                        try:
-                            md.small.ttspecRefAmpl = es.value(args.instrument + ':TTSPEC:REFAMPL')
-                            if md.small.ttspecRefAmpl is None: md.small.ttspecRefAmpl = 0
-                        except:
-                            md.small.ttspecRefAmpl = 0
-
-                        if evr0:
-                            ec = evr0.eventCodes(evt)
-                            if ec is None: ec = [-1]
-                            md.addarray('evr0', np.array(ec))
-
-                        if evr1:
-                            ec = evr1.eventCodes(evt)
-                            if ec is None: ec = [-1]
-                            md.addarray('evr1', np.array(ec))
-
-                        # pulse length
-                        try:
-                            pulseLength = es.value('SIOC:SYS0:ML00:AO820') * 1e-15  # s
-                        except:
-                            pulseLength = 0
-
-                        md.small.pulseLength = pulseLength
-
-                        md.small.detectorDistance = detectorDistance
-
-                        md.small.pixelSize = args.pixelSize
-
-                        # LCLS
-                        if "cxi" in args.exp:
-                            md.small.lclsDet = es.value(args.clen)  # mm
-                        elif "mfx" in args.exp:
-                            md.small.lclsDet = es.value(args.clen)  # mm
-                        elif "xpp" in args.exp:
-                            md.small.lclsDet = es.value(args.clen)  # mm
-
-                        try:
-                            md.small.ebeamCharge = es.value('BEND:DMP1:400:BDES')
-                        except:
-                            md.small.ebeamCharge = 0
-
-                        try:
-                            md.small.beamRepRate = es.value('EVNT:SYS0:1:LCLSBEAMRATE')
-                        except:
-                            md.small.beamRepRate = 0
-
-                        try:
-                            md.small.particleN_electrons = es.value('BPMS:DMP1:199:TMIT1H')
-                        except:
-                            md.small.particleN_electrons = 0
-
-                        try:
-                            md.small.eVernier = es.value('SIOC:SYS0:ML00:AO289')
-                        except:
-                            md.small.eVernier = 0
-
-                        try:
-                            md.small.charge = es.value('BEAM:LCLS:ELEC:Q')
-                        except:
-                            md.small.charge = 0
-
-                        try:
-                            md.small.peakCurrentAfterSecondBunchCompressor = es.value('SIOC:SYS0:ML00:AO195')
-                        except:
-                            md.small.peakCurrentAfterSecondBunchCompressor = 0
-
-                        try:
-                            md.small.pulseLength = es.value('SIOC:SYS0:ML00:AO820')
-                        except:
-                            md.small.pulseLength = 0
-
-                        try:
-                            md.small.ebeamEnergyLossConvertedToPhoton_mJ = es.value('SIOC:SYS0:ML00:AO569')
-                        except:
-                            md.small.ebeamEnergyLossConvertedToPhoton_mJ = 0
-
-                        try:
-                            md.small.calculatedNumberOfPhotons = es.value('SIOC:SYS0:ML00:AO580') * 1e12  # number of photons
-                        except:
-                            md.small.calculatedNumberOfPhotons = 0
-
-                        try:
-                            md.small.photonBeamEnergy = es.value('SIOC:SYS0:ML00:AO541')
-                        except:
-                            md.small.photonBeamEnergy = 0
-
-                        try:
-                            md.small.wavelength = es.value('SIOC:SYS0:ML00:AO192')
-                        except:
-                            md.small.wavelength = 0
-
-                        ebeam = ebeamDet.get(ps.evt)  # .get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
-                        try:
-                            photonEnergy = md.small.photonBeamEnergy #ebeam.ebeamPhotonEnergy()
-                            pulseEnergy = ebeam.ebeamL3Energy()  # MeV
-                        except:
-                            photonEnergy = 0
-                            pulseEnergy = 0
-                            if md.small.wavelength > 0:
-                                h = 6.626070e-34  # J.m
-                                c = 2.99792458e8  # m/s
-                                joulesPerEv = 1.602176621e-19  # J/eV
-                                photonEnergy = (h / joulesPerEv * c) / (md.small.wavelength * 1e-9)
-
-                        md.small.photonEnergy = photonEnergy
-                        md.small.pulseEnergy = pulseEnergy
-
-                        evtId = ps.evt.get(psana.EventId)
-                        md.small.sec = evtId.time()[0]
-                        md.small.nsec = evtId.time()[1]
-                        md.small.fid = evtId.fiducials()
-
-                        if len(d.peakFinder.peaks) >= args.minPeaks and \
-                                        len(d.peakFinder.peaks) <= args.maxPeaks and \
-                                        d.peakFinder.maxRes >= args.minRes and \
-                                        pairsFoundPerSpot >= likelihoodThresh:
-                            # Write image in cheetah format
-                            img = ps.getCheetahImg()
-                            if img is not None: md.addarray('data', img)
-
-                        if args.profile:
-                            totalTime = time.time() - startTic
-                            md.small.totalTime = totalTime
-                            md.small.rankID = rank
-                        md.send()  # send mpi data object to master when desired
-                    elif facility == 'PAL':
-                        if len(d.peakFinder.peaks) >= args.minPeaks and \
-                                        len(d.peakFinder.peaks) <= args.maxPeaks and \
-                                        d.peakFinder.maxRes >= args.minRes:
-                            # Write image in cheetah format
-                            if detarr is not None: md.addarray('data', detarr)
-                        md.small.detectorDistance = detectorDistance
-                        md.small.photonEnergy = photonEnergy
-                        md.send()
-
-        except:
-            print "I can't help you: ", rank
-            pass
-
-    # At the end of the run, send the powder of hits and misses
-    if facility == 'LCLS':
-        md = mpidata()
-        md.small.powder = 1
-        md.addarray('powderHits', d.peakFinder.powderHits)
-        md.addarray('powderMisses', d.peakFinder.powderMisses)
-        md.send()
-        md.endrun()
-        print "Done: ", rank
-    elif facility == 'PAL':
-        md = mpidata()
-        md.small.powder = 1
-        md.addarray('powderHits', d.peakFinder.powderHits)
-        md.addarray('powderMisses', d.peakFinder.powderMisses)
-        md.send()
+    # At the end of the run, send the powder of hits and misses. Clients that got no image have no
+    # peak finder and only end the run, which the master waits for
+    md = mpidata()
+    try:
+        if hasattr(d, 'peakFinder'):
+            d.peakFinder.addPowder(md)
+            md.send()
+    finally:
         md.endrun()
-        print "Done: ", rank
-
-def calculate_likelihood(qPeaks):
-
-    nPeaks = int(qPeaks.shape[1])
-    selfD = distance.cdist(qPeaks.transpose(), qPeaks.transpose(), 'euclidean')
-    sortedSelfD = np.sort(selfD)
-    closestNeighborDist = sortedSelfD[:, 1]
-    meanClosestNeighborDist = np.median(closestNeighborDist)
-    closestPeaks = [None] * nPeaks
-    coords = qPeaks.transpose()
-    pairsFound = 0.
-
-    for ii in range(nPeaks):
-        index = np.where(selfD[ii, :] == closestNeighborDist[ii])
-        closestPeaks[ii] = coords[list(index[0]), :].copy()
-        p = coords[ii, :]
-        flip = 2 * p - closestPeaks[ii]
-        d = distance.cdist(coords, flip, 'euclidean')
-        sigma = closestNeighborDist[ii] / 4.
-        mu = 0.
-        bins = d
-        vals = np.exp(-(bins - mu) ** 2 / (2. * sigma ** 2))
-        weight = np.sum(vals)
-        pairsFound += weight
-
-    pairsFound = pairsFound / 2.
-    pairsFoundPerSpot = pairsFound / float(nPeaks)
-
-    return [meanClosestNeighborDist, pairsFoundPerSpot]
+    print "Done: ", rank
 
 def readCrystfelGeometry(geomFile, facility):
     if facility == 'PAL':
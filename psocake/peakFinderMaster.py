@@ -1,10 +1,12 @@
 import h5py, json
-from mpidata import mpidata
+from mpidata import mpidata, workqueue, creditmanager
 import time
 import numpy as np
 import os
+import threading, Queue
+from flushPolicy import FlushPolicy
 
-from mpi4py import MPI
+from localmpi import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
@@ -32,22 +34,76 @@ def convert_peaks_to_cheetah(s, r, c) :
     col2d = (int(s)/8) * cols + int(c) # where s/8 is a quad number [0,3]
     return row2d, col2d
 
-def getNoe(args):
-    if facility == 'LCLS':
-        runStr = "%04d" % args.run
-        access = "exp=" + args.exp + ":run=" + runStr + ':idx'
-        if 'ffb' in args.access.lower(): access += ':dir=/reg/d/ffb/' + args.exp[:3] + '/' + args.exp + '/xtc'
-        ds = psana.DataSource(access)
-        run = ds.runs().next()
-        times = run.times()
-        numJobs = len(times)
-    elif facility == 'PAL':
-        _temp = args.dir + '/' + args.exp[:3] + '/' + args.exp + '/data/run' + str(args.run).zfill(4) + '/*.h5'
-        numJobs = len(glob.glob(_temp))
-    # check if the user requested specific number of events
-    if args.noe > -1 and args.noe <= numJobs:
-        numJobs = args.noe
-    return numJobs
+def convert_peaks_to_cheetah_array(s, r, c):
+    """Vectorized convert_peaks_to_cheetah for arrays of seg, row, col
+    """
+    segs, rows, cols = (32,185,388)
+    s = np.asarray(s).astype(np.int64)
+    row2d = (s%8) * rows + np.asarray(r).astype(np.int64)
+    col2d = (s//8) * cols + np.asarray(c).astype(np.int64)
+    return row2d, col2d
+
+def getPeakRows(peaks, maxNumPeaks=2048):
+    """Returns zero-padded rows of peak x, y positions (cheetah format) and total intensities
+    """
+    posX = np.zeros((maxNumPeaks,))
+    posY = np.zeros((maxNumPeaks,))
+    atot = np.zeros((maxNumPeaks,))
+    nPeaks = peaks.shape[0]
+    if nPeaks > 0:
+        if facility == 'LCLS':
+            # seg,row,col,npix,amax,atot,rcent,ccent,rsigma,csigma,rmin,rmax,cmin,cmax,bkgd,rms,son
+            cheetahRow, cheetahCol = convert_peaks_to_cheetah_array(peaks[:,0], peaks[:,1], peaks[:,2])
+            posX[:nPeaks] = cheetahCol
+            posY[:nPeaks] = cheetahRow
+            atot[:nPeaks] = peaks[:,5]
+        elif facility == 'PAL':
+            # seg,row,col,npix,atot,son
+            posX[:nPeaks] = peaks[:,2]
+            posY[:nPeaks] = peaks[:,1]
+            atot[:nPeaks] = peaks[:,4]
+    return posX, posY, atot
+
+class PeakTableBuffer:
+    """Buffers per-event peak rows and writes them to the (numEvents, maxNumPeaks) datasets in slabs
+    """
+    def __init__(self, h5file, dsetNames, maxNumPeaks=2048, numBuffer=100):
+        self.h5file = h5file
+        self.dsetNames = dsetNames
+        self.numBuffer = numBuffer
+        self.rows = np.zeros((len(dsetNames), numBuffer, maxNumPeaks))
+        self.eventNums = []
+
+    def add(self, eventNum, rows):
+        ind = len(self.eventNums)
+        for i, row in enumerate(rows):
+            self.rows[i, ind, :] = row
+        self.eventNums.append(eventNum)
+        if len(self.eventNums) == self.numBuffer:
+            self.write()
+
+    def write(self):
+        if len(self.eventNums) == 0: return
+        eventNums = np.array(self.eventNums)
+        # Sorted unique event numbers, keeping the last row received for an event
+        _, ind = np.unique(eventNums[::-1], return_index=True)
+        ind = len(eventNums) - 1 - ind
+        eventNums = eventNums[ind]
+        # Write each run of consecutive events as a single slab
+        breaks = np.where(np.diff(eventNums) != 1)[0] + 1
+        for start, stop in zip(np.append(0, breaks), np.append(breaks, len(eventNums))):
+            evtStart = eventNums[start]
+            evtStop = eventNums[stop-1] + 1
+            for i, name in enumerate(self.dsetNames):
+                self.h5file[name][evtStart:evtStop, :] = self.rows[i, ind[start:stop], :]
+        self.eventNums = []
+
+def getNoe(fname):
+    # Number of events to process, set by findPeaks when it created the cxi file
+    f = h5py.File(fname, 'r')
+    numEvents = f["/entry_1/result_1/nPeaksAll"].shape[0]
+    f.close()
+    return numEvents
 
 def reshapeHdf5(h5file, dataset, ind, numAppend):
     h5file[dataset].resize((ind + numAppend,))
@@ -55,17 +111,239 @@ def reshapeHdf5(h5file, dataset, ind, numAppend):
 def cropHdf5(h5file, dataset, ind):
     h5file[dataset].resize((ind,))
 
+def getNumAppend(numHits, numProcessed, numEvents, minAppend=10, minProcessed=100):
+    """Returns the number of rows to grow the hit datasets by.
+       Grows geometrically (doubling) or up to the number of hits projected from the current hit rate,
+       whichever is larger, so the number of resizes grows logarithmically with the number of hits.
+    """
+    numAppend = max(minAppend, numHits)
+    if numProcessed >= minProcessed:
+        projected = int(np.ceil(numHits * float(numEvents) / numProcessed))
+        numAppend = max(numAppend, projected - numHits)
+    # There can't be more hits than events
+    return max(1, min(numAppend, numEvents - numHits))
+
+def getHitEvents(h5file, dataset, numHits):
+    """Returns the set of event numbers already saved as hits
+    """
+    return set(h5file[dataset][:numHits].tolist())
+
 def updateHdf5(h5file, dataset, ind, val):
     try:
         h5file[dataset][ind] = val
     except:
         h5file[dataset][ind] = 0
 
-def runmaster(args, nClients):
+def getNumCommitted(h5file):
+    """Returns the number of hits committed to the cxi file, recorded at every flush
+    """
+    return int(h5file['/entry_1/result_1/nPeaks'].attrs.get('numEvents', 0))
 
+def resumeCxi(args):
+    """Prepares an existing cxi file for resuming and returns the event numbers left to process.
+       Events that pass the hit criteria but are not among the committed hits are marked as not done (-1).
+    """
     runStr = "%04d" % args.run
     fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
     grpName = "/entry_1/result_1"
+    # Shards left by a run with sub-aggregators that didn't finish hold the events they committed
+    numShards = 0
+    while os.path.exists(getShardFname(args, numShards + 1)): numShards += 1
+    if numShards > 0:
+        mergeShards(args, numShards)
+        print "findPeaks: merged shards left by the previous run: ", numShards
+    myHdf5 = h5py.File(fname, 'r+')
+    if '/status/findPeaks' in myHdf5: del myHdf5['/status/findPeaks']
+    myHdf5['/status/findPeaks'] = 'fail'
+    numHits = getNumCommitted(myHdf5)
+    nPeaksAll = myHdf5[grpName + "/nPeaksAll"].value
+    maxResAll = myHdf5[grpName + "/maxResAll"].value
+    isHit = (nPeaksAll >= args.minPeaks) & (nPeaksAll <= args.maxPeaks) & (maxResAll >= args.minRes)
+    committed = np.zeros_like(isHit)
+    committed[myHdf5['/' + facility + '/eventNumber'][:numHits]] = True
+    nPeaksAll[isHit & ~committed] = -1
+    myHdf5[grpName + "/nPeaksAll"][...] = nPeaksAll
+    myHdf5.flush()
+    myHdf5.close()
+    return np.where(nPeaksAll == -1)[0]
+
+def getShardFname(args, shard):
+    runStr = "%04d" % args.run
+    return args.outDir +"/"+ args.exp +"_"+ runStr + "_shard" + str(shard) + ".cxi"
+
+def getDatasets(h5file, numEvents):
+    """Returns the names of the per-event datasets (numEvents long) and of the hit datasets (resizable)
+    """
+    grpName = "/entry_1/result_1"
+    perEvent = []
+    perHit = []
+    def collect(name, obj):
+        if not isinstance(obj, h5py.Dataset) or obj.shape == (): return
+        if obj.maxshape[0] is None:
+            if not name.endswith('reshapeTime'): perHit.append('/' + name)
+        elif name.startswith(grpName[1:]) and obj.shape[0] == numEvents:
+            perEvent.append('/' + name)
+    h5file.visititems(collect)
+    return perEvent, perHit
+
+def copyLayout(src, dst, perHit):
+    # Copies the groups, links and datasets of src to dst, with the hit datasets empty
+    for key, value in src.attrs.items():
+        dst.attrs[key] = value
+    for key in src.keys():
+        link = src.get(key, getlink=True)
+        if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            dst[key] = link
+            continue
+        obj = src[key]
+        if isinstance(obj, h5py.Group):
+            copyLayout(obj, dst.create_group(key), perHit)
+        elif obj.name in perHit:
+            dset = dst.create_dataset(key, (0,) + obj.shape[1:], maxshape=obj.maxshape, chunks=obj.chunks,
+                                      dtype=obj.dtype, compression=obj.compression,
+                                      compression_opts=obj.compression_opts, fillvalue=obj.fillvalue)
+            for attr, value in obj.attrs.items():
+                dset.attrs[attr] = value
+        else:
+            src.copy(obj, dst, name=key)
+
+def createShards(args, numShards):
+    """Creates the shard files written by the sub-aggregators, with the layout and per-event datasets
+       of the cxi file but no hits
+    """
+    runStr = "%04d" % args.run
+    fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
+    myHdf5 = h5py.File(fname, 'r')
+    _, perHit = getDatasets(myHdf5, myHdf5["/entry_1/result_1/nPeaksAll"].shape[0])
+    for shard in range(1, numShards + 1):
+        f = h5py.File(getShardFname(args, shard), 'w')
+        copyLayout(myHdf5, f, perHit)
+        for name in perHit:
+            if 'numEvents' in f[name].attrs: f[name].attrs['numEvents'] = 0
+        f["/entry_1/result_1/nPeaks"].attrs['numEvents'] = 0
+        f.close()
+    myHdf5.close()
+
+def getRuns(ind, maxLen=1000):
+    """Returns (start, stop) of runs of consecutive sorted indices, at most maxLen long
+    """
+    runs = []
+    if len(ind) == 0: return runs
+    breaks = np.where(np.diff(ind) != 1)[0] + 1
+    for start, stop in zip(np.append(0, breaks), np.append(breaks, len(ind))):
+        for i in range(start, stop, maxLen):
+            runs.append((ind[i], ind[min(i + maxLen, stop) - 1] + 1))
+    return runs
+
+def mergeShards(args, numShards):
+    """Merges the shards written by the sub-aggregators into the cxi file and deletes them.
+       Per-event datasets (numJobs long) are copied for the events each shard processed,
+       hits committed by each shard are appended to the hit datasets.
+    """
+    runStr = "%04d" % args.run
+    fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
+    grpName = "/entry_1/result_1"
+    myHdf5 = h5py.File(fname, 'r+')
+    numEvents = myHdf5[grpName + "/nPeaksAll"].shape[0]
+    numHits = getNumCommitted(myHdf5)
+    perEvent, perHit = getDatasets(myHdf5, numEvents)
+    for shard in range(1, numShards + 1):
+        shardFname = getShardFname(args, shard)
+        try:
+            f = h5py.File(shardFname, 'r')
+        except IOError:
+            print "Could not read shard, its events are processed again: ", shardFname
+            continue
+        # Events processed by this shard
+        ind = np.where((f[grpName + "/nPeaksAll"].value != -1) & (myHdf5[grpName + "/nPeaksAll"].value == -1))[0]
+        for name in perEvent:
+            for start, stop in getRuns(ind):
+                myHdf5[name][start:stop] = f[name][start:stop]
+        # Shards start without hits
+        numShardHits = getNumCommitted(f)
+        for name in perHit:
+            # Datasets with fewer rows than hits (e.g. evr codes not recorded) are filled up with the fill value,
+            # so all hit datasets stay aligned
+            numRows = min(numShardHits, f[name].shape[0])
+            myHdf5[name].resize((numHits + numShardHits,) + myHdf5[name].shape[1:])
+            for i in range(0, numRows, 100):
+                n = min(100, numRows - i)
+                myHdf5[name][numHits+i:numHits+i+n] = f[name][i:i+n]
+            if numRows < numShardHits:
+                myHdf5[name][numHits+numRows:numHits+numShardHits] = \
+                    np.full((numShardHits - numRows,) + myHdf5[name].shape[1:], myHdf5[name].fillvalue,
+                            dtype=myHdf5[name].dtype)
+        numHits += numShardHits
+        f.close()
+        for name in perHit:
+            if 'numEvents' in myHdf5[name].attrs: myHdf5[name].attrs['numEvents'] = numHits
+        myHdf5[grpName + "/nPeaks"].attrs['numEvents'] = numHits
+        myHdf5.flush()
+        os.remove(shardFname)
+    myHdf5.close()
+    return numHits
+
+def runcoordinator(args, numAggregators):
+    """Rank 0 with sub-aggregators: hands out work to the sub-aggregators, merges their shards
+       and saves the powder
+    """
+    runStr = "%04d" % args.run
+    fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
+    statusFname = args.outDir + "/status_peaks.txt"
+    powder = {}
+
+    f = h5py.File(fname, 'r')
+    nPeaksAll = f["/entry_1/result_1/nPeaksAll"].value
+    f.close()
+    numClients = size - 1 - numAggregators
+    work = workqueue(np.where(nPeaksAll == -1)[0], args.chunkSize, numClients)
+    nClients = numAggregators
+    while nClients > 0:
+        md = mpidata()
+        md.recv()
+        if md.small.endrun:
+            nClients -= 1
+        elif md.small.request:
+            md.sendwork(work.next())
+        elif hasattr(md.small, 'powder') and md.small.powder == 1:
+            addPowder(powder, md)
+
+    numHits = mergeShards(args, numAggregators)
+    print "Merged shards: ", numAggregators
+    myHdf5 = h5py.File(fname, 'r+')
+    if '/status/findPeaks' in myHdf5: del myHdf5['/status/findPeaks']
+    myHdf5['/status/findPeaks'] = 'success'
+    myHdf5.close()
+    try:
+        hitRate = numHits * 100. / len(nPeaksAll)
+        d = {"numHits": numHits, "hitRate(%)": round(hitRate,3), "fracDone(%)": 100., "projected": numHits}
+        writeStatus(statusFname, d)
+    except:
+        pass
+    savePowder(args, powder)
+
+def markDone(notDone, eventNum):
+    # Returns 1 if eventNum was not processed before, 0 otherwise
+    if notDone[eventNum]:
+        notDone[eventNum] = False
+        return 1
+    return 0
+
+def putQueue(writeQueue, item, writer):
+    # Blocks while the queue is full, but gives up if the writer died
+    while True:
+        try:
+            writeQueue.put(item, timeout=1)
+            return
+        except Queue.Full:
+            if not writer.isAlive():
+                raise RuntimeError("cxi writer stopped unexpectedly")
+
+def writeCxi(args, myHdf5, writeQueue, commit, credits, numEvents, numDone, mask, statusFname):
+    """Drains the write queue in batches and saves the received events to the cxi file.
+       A None in the queue marks the end of the run. The file is flushed according to the commit policy.
+    """
+    grpName = "/entry_1/result_1"
     dset_nPeaks = "/nPeaksAll"
     dset_posX = "/peakXPosRawAll"
     dset_posY = "/peakYPosRawAll"
@@ -81,65 +359,50 @@ def runmaster(args, nClients):
     dset_peakTime = "/peakTime"
     dset_totalTime = "/totalTime"
     dset_rankID = "/rankID"
-    statusFname = args.outDir + "/status_peaks.txt"
+    dset_queueDepth = "/queueDepth"
+    dset_writerLag = "/writerLag"
+    dset_stallTime = "/stallTime"
 
-    powderHits = None
-    powderMisses = None
-
-    maxSize = 0
+    # Append after the committed hits when resuming
+    maxSize = myHdf5[grpName + "/nPeaks"].shape[0]
     numInc = 0
-    inc = 10
-    dataShape = (0,0)
-    numProcessed = 0
-    numHits = 0
+    minInc = 10
+    totalReshapeTime = 0.0
+    dataShape = myHdf5["/entry_1/data_1/data"].shape[1:]
+    numProcessed = numDone
+    numHits = getNumCommitted(myHdf5)
     hitRate = 0.0
     fracDone = 0.0
     projected = 0.0
     likelihood = 0.0
-    timeToolDelay = 0.0
-    laserTimeZero = 0.0
-    laserTimeDelay = 0.0
-    laserTimePhaseLocked = 0.0
-    numEvents = getNoe(args)
-    d = {"numHits": numHits, "hitRate(%)": hitRate, "fracDone(%)": fracDone, "projected": projected}
-    try:
-        writeStatus(statusFname, d)
-    except:
-        pass
-
-    # Init mask
-    mask = None
-    if args.mask is not None:
-        f = h5py.File(args.mask, 'r')
-        mask = f['/entry_1/data_1/mask'].value
-        f.close()
-        mask = -1*(mask-1)
 
-    myHdf5 = h5py.File(fname, 'r+')
-    numLeft = 1
-    while nClients > 0 and numLeft > 0:
-        # Remove client if the run ended
-        md = mpidata()
-        md.recv()
-        if md.small.endrun:
-            nClients -= 1
-        elif hasattr(md.small, 'powder') and md.small.powder == 1:
-            if powderHits is None:
-                powderHits = md.powderHits
-                powderMisses = md.powderMisses
-            else:
-                powderHits = np.maximum(powderHits, md.powderHits)
-                powderMisses = np.maximum(powderMisses, md.powderMisses)
-        else:
+    # Event numbers saved as hits, used to reject events processed more than once
+    hitEvents = getHitEvents(myHdf5, '/' + facility + '/eventNumber', numHits)
+    peakBuffer = PeakTableBuffer(myHdf5, [grpName + dset_posX, grpName + dset_posY, grpName + dset_atot])
+    done = False
+    while not done:
+        # Wait for an event, then take everything else already queued. Stop waiting if a flush is
+        # requested (SIGUSR1, SIGTERM) so it is done while idle
+        batch = []
+        while not batch:
+            try:
+                batch.append(writeQueue.get(timeout=1))
+            except Queue.Empty:
+                if commit.requested: break
+        while batch:
+            try:
+                batch.append(writeQueue.get_nowait())
+            except Queue.Empty:
+                break
+        for md in batch:
+            if md is None:
+                done = True
+                break
             try:
                 nPeaks = md.peaks.shape[0]
                 maxRes = md.small.maxRes
 
-                # FIXME
-                if facility == 'LCLS' and numHits > 0:
-                    alreadyDone = len(np.where(myHdf5["/LCLS/eventNumber"].value[:numHits] == md.small.eventNum)[0])
-                    #print "alreadyDone: ", myHdf5["/LCLS/eventNumber"].value, myHdf5["/LCLS/eventNumber"].value[:numHits], len(np.where(myHdf5["/LCLS/eventNumber"].value == md.small.eventNum)[0])
-                    if alreadyDone >= 1: continue
+                if md.small.eventNum in hitEvents: continue
 
                 if args.profile:
                     calibTime = md.small.calibTime
@@ -148,7 +411,6 @@ def runmaster(args, nClients):
                     rankID = md.small.rankID
             except:
                 myHdf5[grpName + dset_nPeaks][md.small.eventNum] = -2
-                numLeft = len(np.where(myHdf5[grpName + dset_nPeaks].value == -1)[0])
                 continue
 
             if nPeaks > 2048: # only save upto maxNumPeaks
@@ -157,27 +419,11 @@ def runmaster(args, nClients):
 
             if args.profile: tic = time.time()
 
-            if facility == 'LCLS':
-                for i,peak in enumerate(md.peaks):
-                    #seg, row, col, npix, atot, son = peak
-                    seg,row,col,npix,amax,atot,rcent,ccent,rsigma,csigma,rmin,rmax,cmin,cmax,bkgd,rms,son = peak[0:17]
-                    cheetahRow,cheetahCol = convert_peaks_to_cheetah(seg,row,col)
-                    myHdf5[grpName+dset_posX][md.small.eventNum,i] = cheetahCol
-                    myHdf5[grpName+dset_posY][md.small.eventNum,i] = cheetahRow
-                    myHdf5[grpName+dset_atot][md.small.eventNum,i] = atot
-                    myHdf5.flush()
-            elif facility == 'PAL':
-                for i, peak in enumerate(md.peaks):
-                    seg, row, col, npix, atot, son = peak
-                    myHdf5[grpName + dset_posX][md.small.eventNum, i] = col
-                    myHdf5[grpName + dset_posY][md.small.eventNum, i] = row
-                    myHdf5[grpName + dset_atot][md.small.eventNum, i] = atot
-                    myHdf5.flush()
+            peakRows = getPeakRows(md.peaks)
+            peakBuffer.add(md.small.eventNum, peakRows)
             myHdf5[grpName+dset_nPeaks][md.small.eventNum] = nPeaks
             myHdf5[grpName+dset_maxRes][md.small.eventNum] = maxRes
 
-            numLeft = len(np.where(myHdf5[grpName + dset_nPeaks].value == -1)[0])
-
             if str2bool(args.auto):
                 likelihood = md.small.likelihood
                 myHdf5[grpName + dset_likelihood][md.small.eventNum] = likelihood
@@ -189,7 +435,6 @@ def runmaster(args, nClients):
                 myHdf5[grpName + dset_laserTimeZero][md.small.eventNum] = md.small.laserTimeZero
                 myHdf5[grpName + dset_laserTimeDelay][md.small.eventNum] = md.small.laserTimeDelay
                 myHdf5[grpName + dset_laserTimePhaseLocked][md.small.eventNum] = md.small.laserTimePhaseLocked
-            myHdf5.flush()
 
             if args.profile:
                 saveTime = time.time() - tic # Time to save the peaks found per event
@@ -198,7 +443,9 @@ def runmaster(args, nClients):
                 myHdf5[grpName + dset_saveTime][md.small.eventNum] = saveTime
                 myHdf5[grpName + dset_totalTime][md.small.eventNum] = totalTime
                 myHdf5[grpName + dset_rankID][md.small.eventNum] = rankID
-                myHdf5.flush()
+                myHdf5[grpName + dset_queueDepth][md.small.eventNum] = md.queueDepth
+                myHdf5[grpName + dset_writerLag][md.small.eventNum] = time.time() - md.recvTime
+                myHdf5[grpName + dset_stallTime][md.small.eventNum] = getattr(md.small, 'stallTime', 0)
 
             # If the event is a hit
             if nPeaks >= args.minPeaks and \
@@ -209,6 +456,7 @@ def runmaster(args, nClients):
                     # Assign a bigger array
                     if maxSize == numHits:
                         if args.profile: tic = time.time()
+                        inc = getNumAppend(numHits, numProcessed, numEvents, minAppend=minInc)
                         reshapeHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHits, inc)
                         myHdf5["/entry_1/result_1/peakXPosRaw"].resize((numHits + inc, 2048))
                         myHdf5["/entry_1/result_1/peakYPosRaw"].resize((numHits + inc, 2048))
@@ -268,14 +516,15 @@ def runmaster(args, nClients):
                             reshapeHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc, 1)
                             reshapeTime = time.time() - tic
                             updateHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc, reshapeTime)
+                            totalReshapeTime += reshapeTime
                         maxSize += inc
                         numInc += 1
 
                     # Save peak information
                     updateHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHits, nPeaks)
-                    myHdf5["/entry_1/result_1/peakXPosRaw"][numHits,:] = myHdf5[grpName+dset_posX][md.small.eventNum,:]
-                    myHdf5["/entry_1/result_1/peakYPosRaw"][numHits,:] = myHdf5[grpName+dset_posY][md.small.eventNum,:]
-                    myHdf5["/entry_1/result_1/peakTotalIntensity"][numHits,:] = myHdf5[grpName+dset_atot][md.small.eventNum,:]
+                    myHdf5["/entry_1/result_1/peakXPosRaw"][numHits,:] = peakRows[0]
+                    myHdf5["/entry_1/result_1/peakYPosRaw"][numHits,:] = peakRows[1]
+                    myHdf5["/entry_1/result_1/peakTotalIntensity"][numHits,:] = peakRows[2]
                     updateHdf5(myHdf5, '/entry_1/result_1/maxRes', numHits, maxRes)
                     updateHdf5(myHdf5, '/entry_1/result_1/likelihood', numHits, likelihood)
                     # Save epics
@@ -331,12 +580,13 @@ def runmaster(args, nClients):
                     myHdf5["/entry_1/data_1/data"][numHits, :, :] = md.data
                     if mask is not None:
                         myHdf5["/entry_1/data_1/mask"][numHits, :, :] = mask
+                    hitEvents.add(md.small.eventNum)
                     numHits += 1
-                    myHdf5.flush()
                 elif facility == 'PAL':
                     # Assign a bigger array
                     if maxSize == numHits:
                         if args.profile: tic = time.time()
+                        inc = getNumAppend(numHits, numProcessed, numEvents, minAppend=minInc)
                         reshapeHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHits, inc)
                         myHdf5["/entry_1/result_1/peakXPosRaw"].resize((numHits + inc, 2048))
                         myHdf5["/entry_1/result_1/peakYPosRaw"].resize((numHits + inc, 2048))
@@ -375,17 +625,15 @@ def runmaster(args, nClients):
                             reshapeHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc, 1)
                             reshapeTime = time.time() - tic
                             updateHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc, reshapeTime)
+                            totalReshapeTime += reshapeTime
                         maxSize += inc
                         numInc += 1
 
                     # Save peak information
                     updateHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHits, nPeaks)
-                    myHdf5["/entry_1/result_1/peakXPosRaw"][numHits, :] = myHdf5[grpName + dset_posX][md.small.eventNum,
-                                                                          :]
-                    myHdf5["/entry_1/result_1/peakYPosRaw"][numHits, :] = myHdf5[grpName + dset_posY][md.small.eventNum,
-                                                                          :]
-                    myHdf5["/entry_1/result_1/peakTotalIntensity"][numHits, :] = myHdf5[grpName + dset_atot][
-                                                                                 md.small.eventNum, :]
+                    myHdf5["/entry_1/result_1/peakXPosRaw"][numHits,:] = peakRows[0]
+                    myHdf5["/entry_1/result_1/peakYPosRaw"][numHits,:] = peakRows[1]
+                    myHdf5["/entry_1/result_1/peakTotalIntensity"][numHits,:] = peakRows[2]
                     updateHdf5(myHdf5, '/entry_1/result_1/maxRes', numHits, maxRes)
                     # Save epics
                     #updateHdf5(myHdf5, '/entry_1/instrument_1/source_1/pulse_width', numHits, md.small.pulseLength)
@@ -426,19 +674,29 @@ def runmaster(args, nClients):
                     myHdf5["/entry_1/data_1/data"][numHits, :, :] = md.data
                     if mask is not None:
                         myHdf5["/entry_1/data_1/mask"][numHits, :, :] = mask
+                    hitEvents.add(md.small.eventNum)
                     numHits += 1
-                    myHdf5.flush()
             numProcessed += 1
+        # Hits are written, let the clients send more
+        for md in batch:
+            if md is not None: credits.release(md)
+        if commit.update(len(batch)) and not done:
+            peakBuffer.write()
+            myHdf5[grpName + "/nPeaks"].attrs["numEvents"] = numHits
+            commit.flush()
             # Update status
-            if numProcessed % 60:
-                try:
-                    hitRate = numHits * 100. / numProcessed
-                    fracDone = numProcessed * 100. / numEvents
-                    projected = hitRate / 100. * numEvents
-                    d = {"numHits": numHits, "hitRate(%)": round(hitRate,3), "fracDone(%)": round(fracDone,3), "projected": round(projected)}
-                    writeStatus(statusFname, d)
-                except:
-                    pass
+            try:
+                hitRate = numHits * 100. / numProcessed
+                fracDone = numProcessed * 100. / numEvents
+                projected = hitRate / 100. * numEvents
+                d = {"numHits": numHits, "hitRate(%)": round(hitRate,3), "fracDone(%)": round(fracDone,3), "projected": round(projected)}
+                writeStatus(statusFname, d)
+            except:
+                pass
+
+    # Write out buffered peaks
+    peakBuffer.write()
+    commit.flush()
 
     # Crop back to the correct size
     if facility == 'LCLS':
@@ -464,9 +722,9 @@ def runmaster(args, nClients):
         cropHdf5(myHdf5, '/LCLS/detector_1/beamRepRate', numHits)
         cropHdf5(myHdf5, '/LCLS/detector_1/particleN_electrons', numHits)
 
-        if hasattr(md, 'evr0'):
+        if myHdf5['/LCLS/detector_1/evr0'].shape[0] > numHits:
             cropHdf5(myHdf5, '/LCLS/detector_1/evr0', numHits)
-        if hasattr(md, 'evr1'):
+        if myHdf5['/LCLS/detector_1/evr1'].shape[0] > numHits:
             cropHdf5(myHdf5, '/LCLS/detector_1/evr1', numHits)
 
         cropHdf5(myHdf5, '/LCLS/eVernier', numHits)
@@ -488,6 +746,8 @@ def runmaster(args, nClients):
             myHdf5["/entry_1/data_1/mask"].resize((numHits, dataShape[0], dataShape[1]))
         if args.profile:
             cropHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc)
+            myHdf5['/entry_1/result_1/reshapeTime'].attrs['numReshapes'] = numInc
+            myHdf5['/entry_1/result_1/reshapeTime'].attrs['totalReshapeTime'] = totalReshapeTime
 
         cropHdf5(myHdf5, '/LCLS/ttspecAmpl', numHits)
         cropHdf5(myHdf5, '/LCLS/ttspecAmplNxt', numHits)
@@ -570,6 +830,8 @@ def runmaster(args, nClients):
             myHdf5["/entry_1/data_1/mask"].resize((numHits, dataShape[0], dataShape[1]))
         if args.profile:
             cropHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc)
+            myHdf5['/entry_1/result_1/reshapeTime'].attrs['numReshapes'] = numInc
+            myHdf5['/entry_1/result_1/reshapeTime'].attrs['totalReshapeTime'] = totalReshapeTime
 
         # Save attributes
         #myHdf5["LCLS/detector_1/EncoderValue"].attrs["numEvents"] = numHits
@@ -621,52 +883,133 @@ def runmaster(args, nClients):
     except:
         pass
 
-    # Save powder patterns
-    if facility == 'LCLS':
-        fnameHits = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxHits.npy"
-        fnameMisses = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxMisses.npy"
-        fnameHitsTxt = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxHits.txt"
-        fnameMissesTxt = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxMisses.txt"
-        fnameHitsNatural = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxHits_natural_shape.npy"
-        fnameMissesNatural = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxMisses_natural_shape.npy"
-
-        # Save powder of hits
-        if powderHits is not None:
-            if powderHits.size == 2 * 185 * 388:  # cspad2x2
-                # DAQ shape
-                asData2x2 = two2x1ToData2x2(powderHits)
-                np.save(fnameHits, asData2x2)
-                np.savetxt(fnameHitsTxt, asData2x2.reshape((-1, asData2x2.shape[-1])), fmt='%0.18e')
-                # Natural shape
-                np.save(fnameHitsNatural, powderHits)
-            else:
-                np.save(fnameHits, powderHits)
-                np.savetxt(fnameHitsTxt, powderHits.reshape((-1, powderHits.shape[-1])), fmt='%0.18e')
-        # Save powder of misses
-        if powderMisses is not None:
-            if powderMisses.size == 2 * 185 * 388:  # cspad2x2
-                # DAQ shape
-                asData2x2 = two2x1ToData2x2(powderMisses)
-                np.save(fnameMisses, asData2x2)
-                np.savetxt(fnameMissesTxt, asData2x2.reshape((-1, asData2x2.shape[-1])), fmt='%0.18e')
-                # Natural shape
-                np.save(fnameMissesNatural, powderMisses)
-            else:
-                np.save(fnameMisses, powderMisses)
-                np.savetxt(fnameMissesTxt, powderMisses.reshape((-1, powderMisses.shape[-1])), fmt='%0.18e')
-    elif facility == 'PAL':
-        fnameHits = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxHits.npy"
-        fnameMisses = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxMisses.npy"
-        # Save powder of hits
-        if powderHits is not None: np.save(fnameHits, powderHits)
-        # Save powder of misses
-        if powderMisses is not None: np.save(fnameMisses, powderMisses)
+def runmaster(args, nClients, shard=None):
+    """Receives events from nClients clients and writes them to the cxi file.
+       With a shard number, runs as a sub-aggregator: writes to its own shard of the cxi file,
+       gets work from rank 0 and sends the powder to rank 0 (see runcoordinator).
+    """
+    runStr = "%04d" % args.run
+    grpName = "/entry_1/result_1"
+    dset_nPeaks = "/nPeaksAll"
+    if shard is None:
+        fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
+        statusFname = args.outDir + "/status_peaks.txt"
+    else:
+        fname = getShardFname(args, shard)
+        statusFname = args.outDir + "/status_peaks_shard" + str(shard) + ".txt"
+
+    powder = {}
 
+    numEvents = getNoe(fname)
+    d = {"numHits": 0, "hitRate(%)": 0.0, "fracDone(%)": 0.0, "projected": 0.0}
+    try:
+        writeStatus(statusFname, d)
+    except:
+        pass
+
+    # Init mask
+    mask = None
+    if args.mask is not None:
+        f = h5py.File(args.mask, 'r')
+        mask = f['/entry_1/data_1/mask'].value
+        f.close()
+        mask = -1*(mask-1)
+
+    myHdf5 = h5py.File(fname, 'r+')
+    # Keep track of unprocessed events (-1 in nPeaksAll) in memory, nPeaksAll is only written from here on
+    notDone = (myHdf5[grpName + dset_nPeaks].value == -1)
+    numLeft = np.count_nonzero(notDone)
+    # Events are written to the cxi file by a separate thread, so receiving doesn't wait on disk
+    writeQueue = Queue.Queue(maxsize=args.writeQueueSize)
+    commit = FlushPolicy(myHdf5, flushEvents=args.flushEvents, flushSeconds=args.flushSeconds)
+    commit.installSignalHandlers()
+    credits = creditmanager(args.hitCredits > 0)
+    writer = threading.Thread(target=writeCxi, args=(args, myHdf5, writeQueue, commit, credits, numEvents,
+                                                     len(notDone) - numLeft, mask, statusFname))
+    writer.daemon = True
+    writer.start()
+    # Clients request chunks of the events left to process, sub-aggregators pass requests on to rank 0
+    work = None
+    if shard is None: work = workqueue(np.where(notDone)[0], args.chunkSize, nClients)
     while nClients > 0:
         # Remove client if the run ended
+        credits.sendcredits()
         md = mpidata()
-        md.recv()
+        md.recv(idle=credits.sendcredits)
         if md.small.endrun:
             nClients -= 1
+            credits.ended.add(md.recvRank)
+        elif md.small.request:
+            if work is not None:
+                md.sendwork(work.next())
+            else:
+                md.sendwork(mpidata().requestwork())
+        elif hasattr(md.small, 'powder') and md.small.powder == 1:
+            addPowder(powder, md)
+        else:
+            numLeft -= markDone(notDone, md.small.eventNum)
+            md.queueDepth = writeQueue.qsize()
+            md.recvTime = time.time()
+            putQueue(writeQueue, md, writer)
+    putQueue(writeQueue, None, writer)
+    writer.join()
+    commit.restoreSignalHandlers()
+
+    if shard is not None:
+        if powder:
+            md = mpidata()
+            md.small.powder = 1
+            for name in powderArrays:
+                if name in powder: md.addarray(name, powder[name])
+            for name in powderCounts:
+                if name in powder: setattr(md.small, name, powder[name])
+            md.send()
+        md = mpidata()
+        md.endrun()
+        return
+
+    if numLeft > 0: print "Events not processed (rerun with --resume): ", numLeft
+    savePowder(args, powder)
+
+powderArrays = ['powderHits', 'powderMisses', 'powderHitsSum', 'powderMissesSum']
+powderCounts = ['numPowderHits', 'numPowderMisses']
+
+def addPowder(powder, md):
+    """Adds the powder sent by a client or sub-aggregator to powder, a dict of the maximum and sum arrays
+       and the event counts
+    """
+    for name in powderArrays:
+        if not hasattr(md, name): continue
+        if name not in powder:
+            powder[name] = np.array(getattr(md, name))
+        elif name.endswith('Sum'):
+            powder[name] += getattr(md, name)
         else:
-            pass
+            np.maximum(powder[name], getattr(md, name), out=powder[name])
+    for name in powderCounts:
+        if hasattr(md.small, name): powder[name] = powder.get(name, 0) + getattr(md.small, name)
+
+def savePowder(args, powder):
+    """Saves the maximum powder of hits and misses, and their mean if the clients sent the sums (--powderMean)
+    """
+    prefix = args.outDir +"/"+ args.exp +"_"+ "%04d" % args.run
+    powders = [("_maxHits", powder.get('powderHits')), ("_maxMisses", powder.get('powderMisses'))]
+    if powder.get('numPowderHits', 0) > 0:
+        powders.append(("_meanHits", powder['powderHitsSum'] / powder['numPowderHits']))
+    if powder.get('numPowderMisses', 0) > 0:
+        powders.append(("_meanMisses", powder['powderMissesSum'] / powder['numPowderMisses']))
+    for suffix, img in powders:
+        if img is None: continue
+        if facility == 'LCLS':
+            if img.size == 2 * 185 * 388:  # cspad2x2
+                # DAQ shape
+                asData2x2 = two2x1ToData2x2(img)
+                np.save(prefix + suffix + ".npy", asData2x2)
+                np.savetxt(prefix + suffix + ".txt", asData2x2.reshape((-1, asData2x2.shape[-1])), fmt='%0.18e')
+                # Natural shape
+                np.save(prefix + suffix + "_natural_shape.npy", img)
+            else:
+                np.save(prefix + suffix + ".npy", img)
+                np.savetxt(prefix + suffix + ".txt", img.reshape((-1, img.shape[-1])), fmt='%0.18e')
+        elif facility == 'PAL':
+            np.save(prefix + suffix + ".npy", img)
@@ -0,0 +1,51 @@
+"""Likelihood that the peaks of an event come from a crystal, used by the auto peak finder and the GUI.
+
+Bragg peaks come in Friedel pairs, so the reflection of a peak through its nearest neighbour tends to
+land on another peak. Each peak scores the Gaussian weights of the peaks around the reflections
+of its nearest neighbours (all of them if several are at the same distance, e.g. on a lattice),
+with sigma a quarter of the nearest neighbour distance.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+numNeighbors = 8 # peaks scored around each reflection before checking for more within the cutoff
+cutoffSigma = 8. # peaks further than this many sigma from a reflection are not scored (weight < 1e-13)
+tieTolerance = 1e-9 # relative difference of distances counted as the same nearest neighbour distance
+
+def calculate_likelihood(qPeaks):
+    """qPeaks: (3, nPeaks) peak positions in reciprocal space
+       Returns [median nearest neighbour distance, pairs found per peak]
+    """
+    coords = np.ascontiguousarray(qPeaks.transpose(), dtype=np.float64)
+    nPeaks = coords.shape[0]
+    if nPeaks < 2: return [0., 0.]
+    tree = cKDTree(coords)
+    dist, _ = tree.query(coords, k=2)
+    closestNeighborDist = dist[:, 1]
+    meanClosestNeighborDist = np.median(closestNeighborDist)
+
+    # Nearest neighbours of each peak, other than the peak itself (unless another peak is at the same position)
+    neighbors = [tree.query_ball_point(coords[ii], closestNeighborDist[ii] * (1. + tieTolerance))
+                 for ii in range(nPeaks)]
+    peak = np.repeat(np.arange(nPeaks), [len(nb) for nb in neighbors])
+    neighbor = np.concatenate([np.asarray(nb, dtype=np.int64) for nb in neighbors])
+    keep = (neighbor != peak) | (closestNeighborDist[peak] == 0)
+    peak = peak[keep]
+    neighbor = neighbor[keep]
+
+    flip = 2 * coords[peak] - coords[neighbor]
+    sigma = closestNeighborDist[peak] / 4.
+    cutoff = cutoffSigma * sigma
+    k = min(numNeighbors, nPeaks)
+    d, _ = tree.query(flip, k=k)
+    d = d.reshape((len(flip), k))
+    weight = np.sum(np.exp(-d ** 2 / (2. * sigma[:, np.newaxis] ** 2)) * (d <= cutoff[:, np.newaxis]), axis=1)
+    # Crowded reflections may have more than k peaks within the cutoff
+    for ii in np.where((d[:, -1] <= cutoff) & (k < nPeaks))[0]:
+        dd = np.sqrt(np.sum((coords[tree.query_ball_point(flip[ii], cutoff[ii])] - flip[ii]) ** 2, axis=1))
+        weight[ii] = np.sum(np.exp(-dd ** 2 / (2. * sigma[ii] ** 2)))
+
+    pairsFound = np.sum(weight) / 2.
+    pairsFoundPerSpot = pairsFound / float(nPeaks)
+
+    return [meanClosestNeighborDist, pairsFoundPerSpot]
@@ -5,6 +5,7 @@ import PSCalib.GlobalUtils as gu
 from PSCalib.GeometryAccess import GeometryAccess
 from pyimgalgos.RadialBkgd import RadialBkgd, polarization_factor
 import Detector.PyDetector
+import eventIndex
 
 class psanaWhisperer():
     def __init__(self, experimentName, runNumber, detInfo, clen='', aduPerPhoton=1, localCalib=False, access='ana'):
@@ -16,13 +17,26 @@ class psanaWhisperer():
         self.localCalib = localCalib
         self.access = access
 
-    def setupExperiment(self):
-        access = 'exp=' + str(self.experimentName) + ':run=' + str(self.runNumber) + ':idx'
-        if 'ffb' in self.access.lower(): access += ':dir=/reg/d/ffb/' + self.experimentName[:3] + \
-                                                   '/' + self.experimentName + '/xtc'
-        self.ds = psana.DataSource(access)
-        self.run = self.ds.runs().next()
-        self.times = self.run.times()
+    def setupExperiment(self, ds=None, run=None, times=None, indexDir=None):
+        """ds, run, times: data source, run and event times already opened by the caller, which are reused
+           indexDir: directory of the event index of the run (see eventIndex.py), used for the event times
+        """
+        if ds is None:
+            access = 'exp=' + str(self.experimentName) + ':run=' + str(self.runNumber) + ':idx'
+            if 'ffb' in self.access.lower(): access += ':dir=/reg/d/ffb/' + self.experimentName[:3] + \
+                                                       '/' + self.experimentName + '/xtc'
+            ds = psana.DataSource(access)
+        self.ds = ds
+        self.run = run if run is not None else self.ds.runs().next()
+        self.eventIndex = None
+        self.eventLookup = None
+        if isinstance(times, eventIndex.eventTimes):
+            self.eventIndex = times.index
+        elif times is None and indexDir is not None:
+            self.eventIndex = eventIndex.getEventIndex(self.experimentName, self.runNumber, indexDir,
+                                                          access=self.access, run=self.run)
+            times = eventIndex.eventTimes(self.eventIndex)
+        self.times = times if times is not None else self.run.times()
         self.eventTotal = len(self.times)
         self.env = self.ds.env()
         self.evt = self.run.event(self.times[0])
@@ -151,14 +165,16 @@ class psanaWhisperer():
         # Gets psana event given cheetahFilename, e.g. LCLS_2015_Jul26_r0014_035035_e820.h5
         hrsMinSec = cheetahFilename.split('_')[-2]
         fid = int(cheetahFilename.split('_')[-1].split('.')[0], 16)
-        for t in self.times:
-            if t.fiducial() == fid:
-                localtime = time.strftime('%H:%M:%S', time.localtime(t.seconds()))
-                localtime = localtime.replace(':', '')
-                if localtime[0:3] == hrsMinSec[0:3]:
-                    self.evt = self.run.event(t)
-                else:
-                    self.evt = None
+        if self.eventLookup is None:
+            index = self.eventIndex if self.eventIndex is not None else eventIndex.makeEventIndex(self.times)
+            self.eventLookup = eventIndex.eventLookup(index)
+        self.evt = None
+        for sec, nsec, event in self.eventLookup.findFiducial(fid):
+            localtime = time.strftime('%H:%M:%S', time.localtime(sec))
+            localtime = localtime.replace(':', '')
+            if localtime[0:3] == hrsMinSec[0:3]:
+                self.evt = self.run.event(self.times[event])
+                break
 
     def getStartTime(self):
         self.evt = self.run.event(self.times[0])